@@ -0,0 +1,337 @@
+import argparse
+import asyncio
+import datetime
+import gzip
+import hashlib
+import inspect
+import json
+import logging
+import os
+import urllib.parse
+
+import duckdb as ddb
+import pyarrow as pa
+
+import queries
+from cache import QueryCache, db_mtime, normalize_param
+from cursor_pool import CursorPool
+from downsample import DEFAULT_METHOD, MIN_POINTS
+
+DB_PATH = 'gridwatch.db'
+HOST = '127.0.0.1'
+PORT = 8502
+# cursors, and threads, requests are answered on
+QUERY_THREADS = int(os.environ.get('GRIDWATCH_QUERY_THREADS', min(4, os.cpu_count() or 1)))
+ARROW_MEDIA_TYPE = 'application/vnd.apache.arrow.stream'
+# smaller bodies are sent as they are, gzip would barely shrink them
+GZIP_MIN_BYTES = 1024
+MAX_WINDOW_SIZE = 365
+REQUEST_TIMEOUT_S = 30
+
+log = logging.getLogger('gridwatch.api')
+
+# endpoint -> query function and the parameters it takes, from the registries in queries.py
+ENDPOINTS = {
+    **{name: (query, ['start', 'end']) for name, query in queries.RANGE_QUERIES.items()},
+    **{name: (query, ['window_size', 'start', 'end']) for name, query in queries.WINDOWED_QUERIES.items()},
+    # the year queries by their own functions, so one that takes no window, e.g. nuclear_output, accepts none
+    **{name: (query, ['year'] + (['window_size'] if 'window_size' in inspect.signature(query).parameters else []))
+       for name, query in ((name, getattr(queries, name)) for name in queries.YEAR_QUERIES)},
+}
+# the queries that can downsample their result also take max_points
+DOWNSAMPLED = {name for name, (query, _) in ENDPOINTS.items() if 'max_points' in inspect.signature(query).parameters}
+STATUS_REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+class ApiError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Payload:
+    # an encoded response body, cached in a QueryCache (which sizes entries by nbytes) together with its ETag and,
+    # once a client has asked for it, its gzipped form
+
+    def __init__(self, body, content_type):
+        self.body = body
+        self.content_type = content_type
+        # weak, as the plain and gzipped bodies share it
+        self.etag = 'W/"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        self.gzipped = None
+
+    @property
+    def nbytes(self):
+        return len(self.body) + len(self.gzipped or b'')
+
+    def gzip_body(self):
+        if self.gzipped is None:
+            self.gzipped = gzip.compress(self.body, compresslevel=5)
+        return self.gzipped
+
+
+def parse_date(name, value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise ApiError(400, f'{name} must be a date like 2023-01-31, got {value!r}')
+
+
+def parse_int(name, value, low, high):
+    try:
+        number = int(value)
+    except ValueError:
+        raise ApiError(400, f'{name} must be an integer, got {value!r}')
+    if not low <= number <= high:
+        raise ApiError(400, f'{name} must be between {low} and {high}, got {number}')
+    return number
+
+
+def parse_params(endpoint, query_string, first, last):
+    # the query function's keyword arguments, with every value checked and the date range clipped to the data
+    args = urllib.parse.parse_qs(query_string, keep_blank_values=True)
+    args = {name: values[-1] for name, values in args.items()}
+    _, names = ENDPOINTS[endpoint]
+    allowed = set(names) | {'format'} | ({'max_points'} if endpoint in DOWNSAMPLED else set()) | ({'columns'} if endpoint == 'interconnector_flows' else set())
+    unknown = set(args) - allowed
+    if unknown:
+        raise ApiError(400, f'Unknown parameters for {endpoint}: {sorted(unknown)}')
+
+    params = {}
+    if 'start' in names:
+        start = parse_date('start', args['start']) if 'start' in args else first
+        end = parse_date('end', args['end']) if 'end' in args else last
+        if start > end:
+            raise ApiError(400, 'start must not be after end')
+        start, end = max(start, first), min(end, last)
+        if start > end:
+            raise ApiError(400, f'start to end must overlap the data, which runs from {first} to {last}')
+        params['start_date'], params['end_date'] = start, end
+    if 'window_size' in names:
+        params['window_size'] = parse_int('window_size', args.get('window_size', '27'), 0, MAX_WINDOW_SIZE)
+    if 'year' in names:
+        if 'year' not in args:
+            raise ApiError(400, 'year is required')
+        params['year'] = parse_int('year', args['year'], first.year, last.year)
+    if 'max_points' in args:
+        # below the default method's minimum a chart cannot be downsampled at all; any budget above it is met however
+        # many series the endpoint returns
+        params['max_points'] = parse_int('max_points', args['max_points'], MIN_POINTS[DEFAULT_METHOD], 1_000_000)
+    if 'columns' in args:
+        columns = [column for column in args['columns'].split(',') if column]
+        unknown = set(columns) - set(queries.INTERCONNECTOR_COLUMNS)
+        if not columns or unknown:
+            raise ApiError(400, f'columns must be some of {queries.INTERCONNECTOR_COLUMNS}')
+        params['columns'] = columns
+    return params
+
+
+def as_arrow(result):
+    return result if isinstance(result, pa.Table) else pa.Table.from_pandas(result, preserve_index=False)
+
+
+def encode(result, output_format):
+    table = as_arrow(result)
+    if output_format == 'arrow':
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return Payload(sink.getvalue().to_pybytes(), ARROW_MEDIA_TYPE)
+    # column names plus one array per row; dates and timestamps as ISO strings
+    table = pa.Table.from_arrays([column.cast(pa.string()) if pa.types.is_date(column.type) else column for column in table.columns],
+                                 names=table.column_names)
+    df = table.to_pandas()
+    rows = df.to_json(orient='values', date_format='iso', date_unit='s')
+    body = f'{{"columns":{json.dumps(list(df.columns))},"rows":{rows}}}'.encode()
+    return Payload(body, 'application/json')
+
+
+def json_payload(value):
+    return Payload(json.dumps(value).encode(), 'application/json')
+
+
+class GridwatchApi:
+    # answers GET /api/<query function>?<parameters> with the result as JSON or an Arrow IPC stream. Queries run on a
+    # pool of read-only DuckDB cursors; encoded responses are cached per database file, and identical requests
+    # arriving together share one computation
+
+    def __init__(self, db_path, threads=QUERY_THREADS, max_cache_bytes=256 * 1024 * 1024):
+        self.db_path = db_path
+        self.threads = threads
+        self.cache = QueryCache(db_path, max_bytes=max_cache_bytes)
+        self._pending = {}
+        self._reopening = asyncio.Lock()
+        self.open()
+        queries.use_result_format('arrow')
+
+    def open(self):
+        # the connection, its cursors and the span of the data, for the database file as it is now; the version is
+        # only recorded once they all open, so a reopen that fails is retried by the next request
+        version = db_mtime(self.db_path)
+        conn = ddb.connect(self.db_path, read_only=True)
+        try:
+            first, last = conn.sql('SELECT MIN(date), MAX(date) FROM warehouse.agg_daily').fetchone()
+        except Exception:
+            conn.close()
+            raise
+        self.version, self.conn, self.first, self.last = version, conn, first, last
+        self.pool = CursorPool(conn, self.threads)
+
+    async def refresh(self):
+        # setup_db.py swaps a rebuilt file in by rename, which the open connection never sees, so reopen once the mtime
+        # moves. DuckDB hands every connection to a path the same database instance while one is open, so the old
+        # cursors are closed first, after the queries still running on them finish; that wait and the reopen run off
+        # the event loop, and requests arriving meanwhile wait for the new connection
+        if db_mtime(self.db_path) == self.version:
+            return
+        async with self._reopening:
+            if db_mtime(self.db_path) != self.version:
+                await asyncio.get_running_loop().run_in_executor(None, self.reopen)
+
+    def reopen(self):
+        self.close()
+        self.open()
+
+    def close(self):
+        self.pool.close()
+        self.conn.close()
+
+    def index(self):
+        return json_payload({
+            'first_date': self.first.isoformat(),
+            'last_date': self.last.isoformat(),
+            'endpoints': {name: sorted(names) for name, (_, names) in ENDPOINTS.items()},
+        })
+
+    async def payload(self, endpoint, query_string, output_format):
+        params = parse_params(endpoint, query_string, self.first, self.last)
+        key = (self.version, endpoint, output_format, tuple(sorted((name, normalize_param(value)) for name, value in params.items())))
+        payload = self.cache.get(key)
+        if payload is not None:
+            return payload
+        if key in self._pending:
+            return await asyncio.shield(self._pending[key])
+
+        query, _ = ENDPOINTS[endpoint]
+        future = asyncio.wrap_future(self.pool.submit(lambda cursor: encode(query(cursor, **params), output_format)))
+        self._pending[key] = future
+        try:
+            payload = await future
+        finally:
+            del self._pending[key]
+        self.cache.put(key, payload)
+        return payload
+
+    async def respond(self, method, target, headers):
+        # (status, payload)
+        if method not in ('GET', 'HEAD'):
+            raise ApiError(405, f'{method} is not supported')
+        await self.refresh()
+        url = urllib.parse.urlsplit(target)
+        path = url.path.rstrip('/')
+        if path in ('', '/api'):
+            return 200, self.index()
+        if path == '/health':
+            return 200, json_payload({'status': 'ok'})
+        endpoint = path.removeprefix('/api/')
+        if not path.startswith('/api/') or endpoint not in ENDPOINTS:
+            raise ApiError(404, f'No such endpoint: {url.path}')
+
+        output_format = urllib.parse.parse_qs(url.query).get('format', [None])[-1]
+        if output_format is None:
+            output_format = 'arrow' if ARROW_MEDIA_TYPE in headers.get('accept', '') else 'json'
+        if output_format not in ('json', 'arrow'):
+            raise ApiError(400, f'format must be json or arrow, got {output_format!r}')
+        return 200, await self.payload(endpoint, url.query, output_format)
+
+    async def handle(self, reader, writer):
+        # HTTP/1.1 with keep-alive; requests on one connection are answered in order
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT_S)
+                if not request_line.strip():
+                    break
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self.reject(writer, 'Malformed request line')
+                    break
+                headers = {}
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT_S)
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = headers.get('content-length', '0')
+                if not length.isdigit():
+                    await self.reject(writer, 'Content-Length must be a number of bytes')
+                    break
+                if int(length):
+                    await reader.readexactly(int(length))
+
+                try:
+                    status, payload = await self.respond(method, target, headers)
+                except ApiError as error:
+                    status, payload = error.status, json_payload({'error': str(error)})
+                except Exception:
+                    # the details, DuckDB's error text included, go to the server log and not to the client
+                    log.exception('%s %s failed', method, target)
+                    status, payload = 500, json_payload({'error': 'Internal server error'})
+                keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+                writer.write(self.response(method, status, payload, headers, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def reject(self, writer, message):
+        # a request that cannot be parsed gets a 400 and the connection is closed, as where the next one starts is unknown
+        writer.write(self.response('GET', 400, json_payload({'error': message}), {}, keep_alive=False))
+        await writer.drain()
+
+    def response(self, method, status, payload, request_headers, keep_alive):
+        headers = {'Content-Type': payload.content_type, 'ETag': payload.etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept, Accept-Encoding'}
+        body = payload.body
+        if status == 200 and payload.etag in request_headers.get('if-none-match', ''):
+            status, body = 304, b''
+        elif len(body) >= GZIP_MIN_BYTES and 'gzip' in request_headers.get('accept-encoding', ''):
+            body = payload.gzip_body()
+            headers['Content-Encoding'] = 'gzip'
+        headers['Content-Length'] = str(len(body))
+        headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+        head = f'HTTP/1.1 {status} {STATUS_REASONS[status]}\r\n' + ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+        return (head + '\r\n').encode('latin-1') + (body if method != 'HEAD' else b'')
+
+
+async def serve(db_path, host, port, threads):
+    api = GridwatchApi(db_path, threads)
+    server = await asyncio.start_server(api.handle, host, port)
+    print(f"Serving {db_path} on http://{host}:{server.sockets[0].getsockname()[1]}/api with {threads} cursors", flush=True)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        api.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the warehouse aggregates as JSON or Arrow over HTTP')
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--threads', type=int, default=QUERY_THREADS, help='read-only DuckDB cursors queries run on')
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    try:
+        asyncio.run(serve(args.db, args.host, args.port, args.threads))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,698 @@
+import argparse
+import asyncio
+import contextlib
+import datetime
+import functools
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import duckdb as ddb
+
+import queries
+import setup_db
+from cache import RangeCache, result_size
+from cursor_pool import CursorPool
+from snapshot import Snapshot
+import synthetic_data
+
+WINDOW_SIZES = [4, 27, 49]
+
+SLIDER_QUERIES = {
+    'time_series_view_demand': lambda conn, window_size, start, end: queries.time_series_view_demand(conn, window_size, start, end),
+    'energy_source_contribution': lambda conn, window_size, start, end: queries.energy_source_contribution(conn, window_size, start, end),
+    'interconnector_flows': lambda conn, window_size, start, end: queries.interconnector_flows(conn, queries.INTERCONNECTOR_COLUMNS, window_size, start, end),
+}
+
+# the same raw rollups against the star schema and against warehouse.gridwatch_wide
+LAYOUTS = {
+    'star': {
+        'source': """warehouse.fct_gridwatch g
+    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
+    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id""",
+        'date': 'dt.timestamp::date',
+        'year': 'dt.year',
+        'prefix': 'eof.',
+    },
+    'wide': {
+        'source': 'warehouse.gridwatch_wide',
+        'date': 'date',
+        'year': 'year',
+        'prefix': '',
+    },
+}
+
+RAW_QUERIES = {
+    'time_series_view_demand': lambda layout: f"""
+    SELECT {layout['date']} as date, SUM({layout['prefix']}demand) as d
+    FROM {layout['source']}
+    WHERE {layout['date']} BETWEEN $1 AND $2
+    GROUP BY 1
+    """,
+    'yearly_avg_energy_source_contribution': lambda layout: f"""
+    SELECT {layout['year']} as year, {', '.join(f"AVG({layout['prefix']}{column}) {column}" for column in queries.ENERGY_MIX_COLUMNS)}
+    FROM {layout['source']}
+    WHERE {layout['date']} BETWEEN $1 AND $2
+    GROUP BY 1
+    """,
+    'energy_source_contribution': lambda layout: f"""
+    SELECT {layout['date']} as date, {', '.join(f"SUM({layout['prefix']}{column}) {column}" for column in queries.ENERGY_MIX_COLUMNS)}
+    FROM {layout['source']}
+    WHERE {layout['date']} BETWEEN $1 AND $2
+    GROUP BY 1
+    """,
+    'interconnector_flows': lambda layout: f"""
+    SELECT {layout['date']} as date, {', '.join(f"SUM({layout['prefix']}{column}) {column}" for column in queries.INTERCONNECTOR_COLUMNS)}
+    FROM {layout['source']}
+    WHERE {layout['date']} BETWEEN $1 AND $2
+    GROUP BY 1
+    """,
+}
+
+
+def run_query_adhoc(conn, query, params=()):
+    # the pre-registry behaviour: every call parses and plans a freshly formatted SQL string
+    df = conn.sql(queries.render_query(query, params)).fetchdf()
+    return df
+
+
+@contextlib.contextmanager
+def adhoc_queries():
+    prepared_run_query = queries.run_query
+    queries.run_query = run_query_adhoc
+    try:
+        yield
+    finally:
+        queries.run_query = prepared_run_query
+
+
+def time_slider_moves(db_path, query, start, end, rounds, reconnect=False):
+    # one call per slider position, like a user dragging the window size from 5 to 50. The dashboard keeps its
+    # connection, and the statements prepared on it, across reruns; reconnect opens one per move instead, which
+    # throws the prepared statements away every time
+    conn = ddb.connect(db_path, read_only=True)
+    try:
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for window_size in range(4, 50):
+                if reconnect:
+                    conn.close()
+                    conn = ddb.connect(db_path, read_only=True)
+                query(conn, window_size, start, end)
+        return time.perf_counter() - started
+    finally:
+        conn.close()
+
+
+def benchmark_prepared_statements(db_path, start, end, rounds=3):
+    results = []
+    moves = rounds * len(range(4, 50))
+    for name, query in SLIDER_QUERIES.items():
+        with adhoc_queries():
+            adhoc = time_slider_moves(db_path, query, start, end, rounds)
+        reconnect = time_slider_moves(db_path, query, start, end, rounds, reconnect=True)
+        prepared = time_slider_moves(db_path, query, start, end, rounds)
+        results.append({'query': name, 'moves': moves, 'adhoc_s': adhoc, 'reconnect_s': reconnect, 'prepared_s': prepared,
+                        'speedup': adhoc / prepared})
+    return results
+
+
+def date_ranges(conn):
+    first, last = conn.sql('SELECT MIN(date), MAX(date) FROM warehouse.agg_daily').fetchone()
+    return {
+        '30 days': (last - datetime.timedelta(days=29), last),
+        '1 year': (last - datetime.timedelta(days=364), last),
+        'full history': (first, last),
+    }
+
+
+def best_time(func, rounds):
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def benchmark_layouts(db_path, rounds=5):
+    results = []
+    with ddb.connect(db_path, read_only=True) as conn:
+        for range_name, (start, end) in date_ranges(conn).items():
+            for name, raw_query in RAW_QUERIES.items():
+                result = {'query': name, 'range': range_name}
+                for layout_name, layout in LAYOUTS.items():
+                    query = raw_query(layout)
+                    result[f'{layout_name}_s'] = best_time(lambda: queries.run_query(conn, query, [start, end]), rounds)
+                result['speedup'] = result['star_s'] / result['wide_s']
+                results.append(result)
+    return results
+
+
+def panel_calls(start, end, window_size=27):
+    # the queries the Data Summaries and Interconnectors tabs issue on a page load
+    return [
+        functools.partial(queries.yearly_avg_energy_demand, start_date=start, end_date=end),
+        functools.partial(queries.yearly_avg_energy_source_contribution, start_date=start, end_date=end),
+        functools.partial(queries.time_series_view_demand, window_size=window_size, start_date=start, end_date=end, max_points=1000),
+        functools.partial(queries.energy_source_contribution, window_size=window_size, start_date=start, end_date=end, max_points=1000),
+        functools.partial(queries.yearly_demand, start_date=start, end_date=end),
+        functools.partial(queries.interconnector_flows, columns=queries.INTERCONNECTOR_COLUMNS, window_size=window_size, start=start, end=end, max_points=1000),
+    ]
+
+
+def benchmark_panels(db_path, start, end, pool_sizes, rounds):
+    # a pool of one cursor separates the pool's own overhead from running queries side by side. Pools larger than
+    # the CPU count can only overlap Python-side work with DuckDB, as each DuckDB query already uses every core
+    calls = panel_calls(start, end)
+    results = []
+    with ddb.connect(db_path, read_only=True) as conn:
+        run_serial = lambda: [call(conn) for call in calls]
+        run_serial()
+        serial = best_time(run_serial, rounds)
+        results.append({'threads': 1, 'mode': 'serial', 'seconds': serial, 'speedup': 1.0})
+
+        for size in pool_sizes:
+            pool = CursorPool(conn, size)
+            run_pooled = lambda: [future.result() for future in [pool.submit(call) for call in calls]]
+            # every cursor prepares its own statements, so warm them all up before timing
+            for _ in range(size):
+                run_pooled()
+            pooled = best_time(run_pooled, rounds)
+            pool.close()
+            results.append({'threads': size, 'mode': 'pool', 'seconds': pooled, 'speedup': serial / pooled, 'cpus': os.cpu_count()})
+    return results
+
+
+def first_render(source, path, start, end):
+    # what a fresh app process does before its first summary charts: open the data and run the yearly queries
+    started = time.perf_counter()
+    if source == 'snapshot':
+        queries.use_snapshot(Snapshot(path))
+        conn = None
+    else:
+        conn = ddb.connect(path, read_only=True)
+    queries.yearly_avg_energy_demand(conn, start, end)
+    queries.yearly_avg_energy_source_contribution(conn, start, end)
+    queries.yearly_demand(conn, start, end)
+    queries.nuclear_output(conn, start.year)
+    return time.perf_counter() - started
+
+
+def benchmark_snapshot(db_path, snapshot_dir, start, end, rounds):
+    # each round is a new process, so neither side benefits from an already warm DuckDB buffer pool or mapping
+    results = []
+    for source, path in (('duckdb', db_path), ('snapshot', snapshot_dir)):
+        timings, peaks = [], []
+        for _ in range(rounds):
+            output = subprocess.run(
+                [sys.executable, __file__, 'first-render', '--source', source, '--path', path,
+                 '--start', start.isoformat(), '--end', end.isoformat()],
+                capture_output=True, text=True, check=True,
+            ).stdout
+            seconds, peak_rss = output.split()
+            timings.append(float(seconds))
+            peaks.append(float(peak_rss))
+        results.append({'source': source, 'seconds': statistics.median(timings), 'peak_rss_mb': statistics.median(peaks)})
+    return results
+
+
+def benchmark_result_formats(db_path, start, end, rounds):
+    calls = {
+        'energy_source_contribution': functools.partial(queries.energy_source_contribution, window_size=27, start_date=start, end_date=end),
+        'interconnector_flows': functools.partial(queries.interconnector_flows, columns=queries.INTERCONNECTOR_COLUMNS, window_size=27, start=start, end=end),
+    }
+    results = []
+    with ddb.connect(db_path, read_only=True) as conn:
+        for name, call in calls.items():
+            # 20 points over the ten series leaves each less than a downsampling method needs
+            for max_points in (None, 1000, 20):
+                row = {'query': name, 'max_points': max_points}
+                for result_format in ('pandas', 'arrow'):
+                    queries.use_result_format(result_format)
+                    run = functools.partial(call, conn, max_points=max_points)
+                    result = run()
+                    if max_points is not None and len(result) > max_points:
+                        raise RuntimeError(f'{name} returned {len(result)} rows for max_points={max_points}')
+                    row[f'{result_format}_s'] = best_time(run, rounds)
+                    row[f'{result_format}_bytes'] = result_size(result)
+                results.append(row)
+    queries.use_result_format('pandas')
+    return results
+
+
+def scrub_ranges(start, end, steps):
+    # a user dragging the end handle of the date slider back a day at a time, then the start handle forward
+    ranges = [(start, end - datetime.timedelta(days=step)) for step in range(steps)]
+    last_end = ranges[-1][1]
+    return ranges + [(start + datetime.timedelta(days=step), last_end) for step in range(1, steps)]
+
+
+def benchmark_range_scrub(db_path, start, end, steps=60, rounds=3):
+    calls = {
+        'time_series_view_demand': functools.partial(queries.time_series_view_demand, window_size=27),
+        'energy_source_contribution': functools.partial(queries.energy_source_contribution, window_size=27),
+        'interconnector_flows': lambda conn, start_date, end_date, max_points: queries.interconnector_flows(
+            conn, queries.INTERCONNECTOR_COLUMNS, 27, start_date, end_date, max_points=max_points),
+    }
+    ranges = scrub_ranges(start, end, steps)
+    results = []
+    with ddb.connect(db_path, read_only=True) as conn:
+        for name, call in calls.items():
+            # the charts downsample to 1000 points, which costs the same either way
+            for max_points in (None, 1000):
+                row = {'query': name, 'max_points': max_points, 'moves': len(ranges)}
+                for mode in ('full', 'incremental'):
+                    def scrub():
+                        queries.use_range_cache(RangeCache(db_path) if mode == 'incremental' else None)
+                        for start_date, end_date in ranges:
+                            call(conn, start_date=start_date, end_date=end_date, max_points=max_points)
+                    row[f'{mode}_s'] = best_time(scrub, rounds)
+                row['speedup'] = row['full_s'] / row['incremental_s']
+                results.append(row)
+    queries.use_range_cache(None)
+    return results
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def api_server(db_path, threads):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), 'api.py'), '--db', db_path,
+                               '--port', str(port), '--threads', str(threads)], stdout=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(f'http://127.0.0.1:{port}/health')
+                break
+            except OSError:
+                time.sleep(0.1)
+        yield port
+    finally:
+        server.terminate()
+        server.wait()
+
+
+async def fetch(reader, writer, path, headers):
+    request = f'GET {path} HTTP/1.1\r\nHost: localhost\r\n' + ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+    writer.write((request + '\r\n').encode())
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while (line := await reader.readline()) not in (b'\r\n', b''):
+        name, _, value = line.decode().partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    body = await reader.readexactly(length)
+    return status, len(body)
+
+
+async def load_api(port, paths, connections, headers):
+    # each connection sends its share of paths one after the other over one keep-alive connection
+    latencies, sizes = [], []
+
+    async def client(share):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        for path in share:
+            started = time.perf_counter()
+            status, size = await fetch(reader, writer, path, headers)
+            if status not in (200, 304):
+                raise RuntimeError(f'{path}: HTTP {status}')
+            latencies.append(time.perf_counter() - started)
+            sizes.append(size)
+        writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client(paths[i::connections]) for i in range(connections)))
+    seconds = time.perf_counter() - started
+    latencies.sort()
+    return {'rps': len(paths) / seconds, 'p50_ms': latencies[len(latencies) // 2] * 1000,
+            'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000, 'kib': statistics.mean(sizes) / 1024}
+
+
+def benchmark_api(db_path, start, end, threads, connections=8, requests=400):
+    # cached: every request repeats one of a few URLs; uncached: every request asks for a window size not seen yet,
+    # so each one runs its query on a cursor
+    with ddb.connect(db_path, read_only=True) as conn:
+        first, last = conn.sql('SELECT MIN(date), MAX(date) FROM warehouse.agg_daily').fetchone()
+    start, end = max(start, first), min(end, last)
+    dates = f'start={start}&end={end}'
+    hot = [f'/api/yearly_avg_energy_demand?{dates}', f'/api/energy_source_contribution?{dates}&max_points=1000',
+           f'/api/interconnector_flows?{dates}&max_points=1000']
+    scenarios = {
+        'cached json': (hot * (requests // len(hot)), {}),
+        'cached json gzip': (hot * (requests // len(hot)), {'Accept-Encoding': 'gzip'}),
+        'cached arrow': (hot * (requests // len(hot)), {'Accept': 'application/vnd.apache.arrow.stream'}),
+        'uncached json': ([f'/api/energy_source_contribution?{dates}&window_size={size % 365}&max_points=1000' for size in range(requests // 4)], {}),
+    }
+    results = []
+    for size in threads:
+        with api_server(db_path, size) as port:
+            for name, (paths, headers) in scenarios.items():
+                if name.startswith('cached'):
+                    asyncio.run(load_api(port, hot, len(hot), headers))
+                result = asyncio.run(load_api(port, paths, connections, headers))
+                results.append({'threads': size, 'scenario': name, 'requests': len(paths), **result})
+    return results
+
+
+def build_star_schema_pandas(db_path, csv_path):
+    setup_db.run_etl_pipeline(csv_path)
+    with ddb.connect(db_path) as conn:
+        setup_db.create_schema(conn)
+        setup_db.create_tables_in_schema(conn)
+
+
+def build_star_schema_sql(db_path, csv_path):
+    with ddb.connect(db_path) as conn:
+        setup_db.run_sql_etl_pipeline(conn, csv_path)
+
+
+def benchmark_etl(csv_path):
+    # star schema only; the aggregate tables are built the same way by both paths
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, build in [('pandas', build_star_schema_pandas), ('sql', build_star_schema_sql)]:
+            db_path = os.path.join(tmp_dir, f'{name}.db')
+            started = time.perf_counter()
+            build(db_path, csv_path)
+            results.append({'pipeline': name, 'seconds': time.perf_counter() - started, 'db_bytes': os.path.getsize(db_path)})
+    return results
+
+
+def benchmark_build_memory(scales, memory_limit, mode='streaming', chunksize=100_000, rounds=3, work_dir=None):
+    # each build runs setup_db.py in a fresh process over a synthetic extract of every scale, so the peak RSS it
+    # reports is that build's alone. The peak moves by a hundred MB or so between identical runs, so every scale is
+    # built `rounds` times; with the memory limit binding, the peak should level off as the file grows
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'setup_db.py')
+    results = []
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        for scale in scales:
+            csv_path = os.path.join(tmp_dir, f'gridwatch_x{scale:g}.csv')
+            db_path = os.path.join(tmp_dir, f'gridwatch_x{scale:g}.db')
+            rows = synthetic_data.generate_csv(csv_path, int(synthetic_data.BASE_ROW_COUNT * scale))
+            command = [sys.executable, script, '--mode', mode, '--csv', csv_path, '--db', db_path, '--chunksize', str(chunksize)]
+            if memory_limit:
+                command += ['--memory-limit', memory_limit]
+
+            result = {'scale': scale, 'rows': rows, 'csv_bytes': os.path.getsize(csv_path)}
+            timings, peaks = [], []
+            for _ in range(rounds):
+                if os.path.exists(db_path):
+                    os.remove(db_path)
+                started = time.perf_counter()
+                build = subprocess.run(command, capture_output=True, text=True, cwd=tmp_dir)
+                timings.append(time.perf_counter() - started)
+                if build.returncode != 0:
+                    result['error'] = build.stderr.strip().splitlines()[-1]
+                    break
+                # the build's last line ends with "peak RSS <n> MB"
+                peaks.append(float(build.stdout.split()[-2]))
+            result['seconds'] = statistics.median(timings)
+            if peaks:
+                result.update({'peak_rss_mb': statistics.median(peaks), 'max_peak_rss_mb': max(peaks)})
+            results.append(result)
+            os.remove(csv_path)
+            if os.path.exists(db_path):
+                os.remove(db_path)
+    return results
+
+
+# what the build inferred from the CSV and pandas before the declared schema, by declared type
+INFERRED_TYPES = {'UINTEGER': 'BIGINT', 'SMALLINT': 'BIGINT', 'INTEGER': 'BIGINT', 'FLOAT': 'DOUBLE', 'USMALLINT': 'INTEGER', 'UTINYINT': 'INTEGER'}
+
+
+def inferred_type(column, column_type):
+    # the aggregates used to keep SUM's HUGEINT and COUNT's BIGINT
+    if column.endswith('_sum') and column_type == 'DOUBLE':
+        return 'HUGEINT'
+    if column.endswith('_count') or column == 'readings':
+        return 'BIGINT'
+    return INFERRED_TYPES.get(column_type, column_type)
+
+
+def copy_with_inferred_types(conn, db_path):
+    # the same warehouse with every column widened back to its inferred type, written to a fresh file
+    conn.execute(f"ATTACH '{db_path}' AS inferred")
+    conn.execute('CREATE SCHEMA inferred.warehouse')
+    tables = conn.sql("SELECT DISTINCT table_name FROM duckdb_columns() WHERE database_name = current_database() AND schema_name = 'warehouse'").fetchall()
+    for (table_name,) in tables:
+        columns = conn.execute("""
+        SELECT column_name, data_type FROM duckdb_columns()
+        WHERE database_name = current_database() AND schema_name = 'warehouse' AND table_name = ?
+        ORDER BY column_index
+        """, [table_name]).fetchall()
+        select = ', '.join(f'{column}::{inferred_type(column, column_type)} as {column}' for column, column_type in columns)
+        conn.execute(f'CREATE TABLE inferred.warehouse.{table_name} AS SELECT {select} FROM warehouse.{table_name}')
+    conn.execute('DETACH inferred')
+
+
+def benchmark_schema(csv_path, rounds=3, work_dir=None):
+    # the declared compact schema against the inferred one: database size, then the raw star-schema rollups
+    # (which scan the 5-minute facts) and a page load of panels over the aggregate tables
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        paths = {'inferred': os.path.join(tmp_dir, 'inferred.db'), 'compact': os.path.join(tmp_dir, 'compact.db')}
+        with ddb.connect(paths['compact']) as conn:
+            setup_db.run_sql_etl_pipeline(conn, csv_path)
+            setup_db.create_agg_tables(conn)
+            copy_with_inferred_types(conn, paths['inferred'])
+        sizes = {name: os.path.getsize(path) for name, path in paths.items()}
+
+        results = []
+        connections = {name: ddb.connect(path, read_only=True) for name, path in paths.items()}
+        for range_name, (start, end) in date_ranges(connections['compact']).items():
+            calls = {name: functools.partial(queries.run_query, query=raw_query(LAYOUTS['star']), params=[start, end])
+                     for name, raw_query in RAW_QUERIES.items()}
+            calls['panels'] = lambda conn: [call(conn) for call in panel_calls(start, end)]
+            for name, call in calls.items():
+                result = {'query': name, 'range': range_name}
+                for schema, conn in connections.items():
+                    call(conn)
+                    result[f'{schema}_s'] = best_time(lambda: call(conn), rounds)
+                result['speedup'] = result['inferred_s'] / result['compact_s']
+                results.append(result)
+        for conn in connections.values():
+            conn.close()
+    return sizes, results
+
+
+def gaps_in_range(conn, start, end):
+    return queries.load_gap_index(conn).overlapping(start, end)
+
+
+def gap_summary(conn):
+    # the outages synthetic_data.py wrote, as the build found them
+    return dict(zip(['interpolated_gaps', 'interpolated_slots', 'missing_gaps', 'missing_slots'], conn.sql('''
+    SELECT COUNT(*) FILTER (WHERE interpolated), SUM(missing_slots) FILTER (WHERE interpolated),
+        COUNT(*) FILTER (WHERE NOT interpolated), SUM(missing_slots) FILTER (WHERE NOT interpolated)
+    FROM warehouse.gap_index
+    ''').fetchone()))
+
+
+def query_cases(conn):
+    ranges = date_ranges(conn)
+    first, last = ranges['full history']
+    year = first.year + (last.year - first.year) // 2
+    cases = []
+    for range_name, (start, end) in ranges.items():
+        for name, query in queries.WINDOWED_QUERIES.items():
+            for window_size in WINDOW_SIZES:
+                cases.append({'query': name, 'range': range_name, 'window': window_size,
+                              'call': functools.partial(query, window_size=window_size, start_date=start, end_date=end)})
+        for name, query in queries.RANGE_QUERIES.items():
+            cases.append({'query': name, 'range': range_name, 'window': None,
+                          'call': functools.partial(query, start_date=start, end_date=end)})
+        # what the dashboard does for the gap caption: load warehouse.gap_index and find the runs in the range
+        cases.append({'query': 'gap_index', 'range': range_name, 'window': None,
+                      'call': functools.partial(gaps_in_range, start=start, end=end)})
+    for name, query in queries.YEAR_QUERIES.items():
+        for window_size in WINDOW_SIZES:
+            cases.append({'query': name, 'range': str(year), 'window': window_size,
+                          'call': functools.partial(query, year=year, window_size=window_size)})
+    return cases
+
+
+def time_query_case(db_path, case, repeats):
+    # cold: first call on a fresh connection, so it pays for opening the file and preparing the statement
+    with ddb.connect(db_path, read_only=True) as conn:
+        started = time.perf_counter()
+        df = case['call'](conn)
+        cold = time.perf_counter() - started
+        warm = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            case['call'](conn)
+            warm.append(time.perf_counter() - started)
+    return {'query': case['query'], 'range': case['range'], 'window': case['window'], 'rows': len(df),
+            'cold_ms': cold * 1000, 'warm_ms': statistics.median(warm) * 1000}
+
+
+def build_synthetic_warehouse(work_dir, scale):
+    csv_path = os.path.join(work_dir, f'gridwatch_x{scale:g}.csv')
+    db_path = os.path.join(work_dir, f'gridwatch_x{scale:g}.db')
+    timings = {}
+
+    started = time.perf_counter()
+    rows = synthetic_data.generate_csv(csv_path, int(synthetic_data.BASE_ROW_COUNT * scale))
+    timings['generate_s'] = time.perf_counter() - started
+
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    started = time.perf_counter()
+    with ddb.connect(db_path) as conn:
+        setup_db.run_sql_etl_pipeline(conn, csv_path)
+        setup_db.create_agg_tables(conn)
+    timings['build_s'] = time.perf_counter() - started
+
+    os.remove(csv_path)
+    return db_path, rows, timings
+
+
+def benchmark_queries(scales, repeats=5, work_dir=None):
+    report = {
+        'generated_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'duckdb_version': ddb.__version__,
+        'python_version': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'scales': [],
+    }
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        for scale in scales:
+            db_path, rows, timings = build_synthetic_warehouse(tmp_dir, scale)
+            with ddb.connect(db_path, read_only=True) as conn:
+                cases = query_cases(conn)
+                gaps = gap_summary(conn)
+            report['scales'].append({
+                'scale': scale,
+                'rows': rows,
+                'gaps': gaps,
+                'db_bytes': os.path.getsize(db_path),
+                **timings,
+                'queries': [time_query_case(db_path, case, repeats) for case in cases],
+            })
+    return report
+
+
+def find_regressions(report, baseline, tolerance):
+    # a case regresses when its warm time grows by more than the tolerance factor (and by at least 1ms,
+    # so sub-millisecond noise doesn't fail the run)
+    baseline_timings = {
+        (scale['scale'], case['query'], case['range'], case['window']): case['warm_ms']
+        for scale in baseline['scales'] for case in scale['queries']
+    }
+    regressions = []
+    for scale in report['scales']:
+        for case in scale['queries']:
+            before = baseline_timings.get((scale['scale'], case['query'], case['range'], case['window']))
+            if before is not None and case['warm_ms'] > before * tolerance and case['warm_ms'] - before > 1:
+                regressions.append({**case, 'scale': scale['scale'], 'baseline_warm_ms': before})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the dashboard query layer')
+    parser.add_argument('suite', nargs='?', choices=['prepared', 'layouts', 'etl', 'queries', 'panels', 'snapshot', 'first-render', 'results', 'schema', 'scrub', 'api', 'memory'], default='prepared')
+    parser.add_argument('--db', default='gridwatch.db')
+    parser.add_argument('--csv', default=setup_db.CSV_PATH)
+    parser.add_argument('--snapshot-dir', default=setup_db.SNAPSHOT_DIR)
+    parser.add_argument('--source', choices=['duckdb', 'snapshot'], help=argparse.SUPPRESS)
+    parser.add_argument('--path', help=argparse.SUPPRESS)
+    parser.add_argument('--start', type=datetime.date.fromisoformat, default=datetime.date(2011, 1, 1))
+    parser.add_argument('--end', type=datetime.date.fromisoformat, default=datetime.date(2024, 12, 31))
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4], help='cursor pool sizes for the panels and api suites')
+    parser.add_argument('--scales', type=float, nargs='+', default=[1], help='synthetic data sizes as multiples of the real extract')
+    parser.add_argument('--memory-limit', default='256MB', help="DuckDB memory_limit for the builds of the memory suite, '' for none")
+    parser.add_argument('--mode', choices=['pandas', 'streaming', 'sql'], default='streaming', help='build mode for the memory suite')
+    parser.add_argument('--work-dir', help='where the synthetic CSV and database are built (defaults to the system temp dir)')
+    parser.add_argument('--output', help='write the queries report as JSON to this path')
+    parser.add_argument('--baseline', help='earlier queries report to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='allowed warm-time growth factor against the baseline')
+    args = parser.parse_args()
+
+    if args.suite == 'prepared':
+        for result in benchmark_prepared_statements(args.db, args.start, args.end, args.rounds):
+            per_move = {key: result[f'{key}_s'] / result['moves'] * 1000 for key in ('adhoc', 'reconnect', 'prepared')}
+            print(f"{result['query']:<30} per move: adhoc {per_move['adhoc']:6.1f}ms  prepared, new connection {per_move['reconnect']:6.1f}ms  "
+                  f"prepared, kept connection {per_move['prepared']:6.1f}ms  x{result['speedup']:.2f}")
+    elif args.suite == 'layouts':
+        # needs a database built with `setup_db.py --wide`
+        for result in benchmark_layouts(args.db, args.rounds):
+            print(f"{result['query']:<40} {result['range']:<13} star {result['star_s'] * 1000:8.1f}ms  wide {result['wide_s'] * 1000:8.1f}ms  x{result['speedup']:.2f}")
+    elif args.suite == 'etl':
+        for result in benchmark_etl(args.csv):
+            print(f"{result['pipeline']:<8} {result['seconds']:8.2f}s  {result['db_bytes'] / 2**20:8.1f} MB")
+    elif args.suite == 'memory':
+        print(f"{args.mode} builds, memory limit {args.memory_limit or 'none'}")
+        for result in benchmark_build_memory(args.scales, args.memory_limit, args.mode, rounds=args.rounds, work_dir=args.work_dir):
+            outcome = (f"peak RSS median {result['peak_rss_mb']:4.0f} MB, max {result['max_peak_rss_mb']:4.0f} MB"
+                       if 'error' not in result else f"FAILED {result['error']}")
+            print(f"x{result['scale']:<5g} {result['rows']:>9} rows {result['csv_bytes'] / 2**20:8.1f} MB CSV  {result['seconds']:7.1f}s  {outcome}")
+    elif args.suite == 'snapshot':
+        # needs a snapshot written with `setup_db.py --snapshot`
+        for result in benchmark_snapshot(args.db, args.snapshot_dir, args.start, args.end, args.rounds):
+            print(f"{result['source']:<9} first render {result['seconds'] * 1000:8.1f}ms  peak RSS {result['peak_rss_mb']:6.0f} MB")
+    elif args.suite == 'first-render':
+        # run by the snapshot suite in a fresh process
+        seconds = first_render(args.source, args.path, args.start, args.end)
+        print(seconds, setup_db.peak_rss_mb())
+    elif args.suite == 'results':
+        for result in benchmark_result_formats(args.db, args.start, args.end, args.rounds):
+            print(f"{result['query']:<28} max_points={str(result['max_points']):<5} "
+                  f"pandas {result['pandas_s'] * 1000:7.1f}ms {result['pandas_bytes'] / 1024:8.0f} KiB  "
+                  f"arrow {result['arrow_s'] * 1000:7.1f}ms {result['arrow_bytes'] / 1024:8.0f} KiB")
+    elif args.suite == 'schema':
+        sizes, results = benchmark_schema(args.csv, args.rounds, args.work_dir)
+        print(f"{'database size':<54} inferred {sizes['inferred'] / 2**20:8.1f}MB  compact {sizes['compact'] / 2**20:8.1f}MB")
+        for result in results:
+            print(f"{result['query']:<40} {result['range']:<13} inferred {result['inferred_s'] * 1000:8.1f}ms  "
+                  f"compact {result['compact_s'] * 1000:8.1f}ms  x{result['speedup']:.2f}")
+    elif args.suite == 'scrub':
+        for result in benchmark_range_scrub(args.db, args.start, args.end, rounds=args.rounds):
+            print(f"{result['query']:<28} max_points={str(result['max_points']):<5} {result['moves']} moves  full {result['full_s'] * 1000:8.1f}ms  "
+                  f"incremental {result['incremental_s'] * 1000:8.1f}ms  x{result['speedup']:.2f}")
+    elif args.suite == 'api':
+        print(f'{os.cpu_count()} CPUs')
+        for result in benchmark_api(args.db, args.start, args.end, args.threads):
+            print(f"{result['threads']:>2} cursors {result['scenario']:<17} {result['requests']:>4} requests {result['rps']:8.0f} req/s  "
+                  f"p50 {result['p50_ms']:6.1f}ms  p99 {result['p99_ms']:6.1f}ms  {result['kib']:6.1f} KiB")
+    elif args.suite == 'panels':
+        print(f'{os.cpu_count()} CPUs')
+        for result in benchmark_panels(args.db, args.start, args.end, args.threads, args.rounds):
+            oversubscribed = ' (more threads than CPUs)' if result['threads'] > (os.cpu_count() or 1) else ''
+            print(f"{result['mode']:<7} {result['threads']:>2} threads {result['seconds'] * 1000:8.1f}ms  x{result['speedup']:.2f}{oversubscribed}")
+    elif args.suite == 'queries':
+        report = benchmark_queries(args.scales, args.rounds, args.work_dir)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        for scale in report['scales']:
+            print(f"x{scale['scale']:g}: {scale['rows']} rows, built in {scale['build_s']:.1f}s, {scale['db_bytes'] / 2**20:.1f} MB")
+            gaps = scale['gaps']
+            print(f"  {gaps['interpolated_gaps']} interpolated gaps ({gaps['interpolated_slots']} slots), "
+                  f"{gaps['missing_gaps']} left missing ({gaps['missing_slots']} slots)")
+            for case in scale['queries']:
+                print(f"  {case['query']:<42} {case['range']:<13} w={str(case['window']):<5} cold {case['cold_ms']:8.1f}ms  warm {case['warm_ms']:8.1f}ms")
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = find_regressions(report, json.load(f), args.tolerance)
+            for case in regressions:
+                print(f"REGRESSION x{case['scale']:g} {case['query']} {case['range']} w={case['window']}: "
+                      f"{case['baseline_warm_ms']:.1f}ms -> {case['warm_ms']:.1f}ms")
+            if regressions:
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
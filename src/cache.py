@@ -0,0 +1,150 @@
+import collections
+import datetime
+import inspect
+import numbers
+import os
+import threading
+
+
+def normalize_param(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, (list, tuple)):
+        return tuple(normalize_param(item) for item in value)
+    if isinstance(value, bool) or value is None or isinstance(value, str):
+        return value
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    if isinstance(value, numbers.Real):
+        return float(value)
+    return value
+
+
+def result_size(result):
+    if hasattr(result, 'memory_usage'):
+        return int(result.memory_usage(index=True, deep=True).sum())
+    if hasattr(result, 'nbytes'):
+        return int(result.nbytes)
+    return 0
+
+
+def db_mtime(db_path):
+    return os.path.getmtime(db_path) if os.path.exists(db_path) else None
+
+
+class QueryCache:
+    # LRU cache of query results keyed on the query function and its parameters, bounded by the
+    # approximate memory of the cached frames and emptied whenever the database file changes
+
+    def __init__(self, db_path, max_bytes=256 * 1024 * 1024):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._db_mtime = None
+        self._lock = threading.Lock()
+
+    def key(self, func, conn, *args, **kwargs):
+        bound = inspect.signature(func).bind(conn, *args, **kwargs)
+        bound.apply_defaults()
+        params = tuple((name, normalize_param(value)) for name, value in bound.arguments.items() if name != 'conn')
+        return (func.__name__, params)
+
+    def _check_db(self):
+        mtime = db_mtime(self.db_path)
+        if mtime != self._db_mtime:
+            self._entries.clear()
+            self._bytes = 0
+            self._db_mtime = mtime
+
+    def get(self, key):
+        with self._lock:
+            self._check_db()
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+
+    def put(self, key, result):
+        size = result_size(result)
+        with self._lock:
+            if size > self.max_bytes:
+                return
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (result, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def call(self, func, conn, *args, **kwargs):
+        # results are shared between callers, so they must be treated as read-only
+        key = self.key(func, conn, *args, **kwargs)
+        result = self.get(key)
+        if result is None:
+            result = func(conn, *args, **kwargs)
+            self.put(key, result)
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class RangeCache:
+    # the last date range each rolling query was computed over, with its rows, so that moving the range only
+    # recomputes the rows the move can reach (see queries.rolling_stats). One range per query and parameters,
+    # at most max_entries of them, emptied whenever the database file changes
+
+    def __init__(self, db_path, max_entries=64):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._db_mtime = None
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        # (start, end, result) of the last range computed for key, or None
+        with self._lock:
+            mtime = db_mtime(self.db_path)
+            if mtime != self._db_mtime:
+                self._entries.clear()
+                self._db_mtime = mtime
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key, start, end, result):
+        with self._lock:
+            self._entries[key] = (start, end, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,110 @@
+import concurrent.futures
+import contextlib
+import queue
+import threading
+
+
+class CursorPool:
+    # a fixed set of cursors on one DuckDB database plus a thread per cursor. Each cursor is its own
+    # connection to the shared database instance, so queries submitted together can run side by side when there
+    # are cores to spare; benchmark.py panels measures whether that pays off on a given machine
+
+    def __init__(self, conn, size, setup=None):
+        self.size = size
+        self._cursors = queue.Queue()
+        for index in range(size):
+            cursor = conn.cursor()
+            if setup is not None:
+                setup(cursor, index)
+            self._cursors.put(cursor)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=size, thread_name_prefix='gridwatch-query')
+
+    @contextlib.contextmanager
+    def cursor(self):
+        cursor = self._cursors.get()
+        try:
+            yield cursor
+        finally:
+            self._cursors.put(cursor)
+
+    def submit(self, func, *args, **kwargs):
+        # func is called with a free cursor as its first argument
+        def run():
+            with self.cursor() as cursor:
+                return func(cursor, *args, **kwargs)
+        return self._executor.submit(run)
+
+    def close(self):
+        self._executor.shutdown()
+        while not self._cursors.empty():
+            self._cursors.get().close()
+
+
+class SerialCursor:
+    # the CursorPool interface over one connection: every query runs inline on the calling thread, and submit hands
+    # back a future that is already done. Sessions on other threads take turns on the connection
+    size = 1
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.RLock()
+
+    @contextlib.contextmanager
+    def cursor(self):
+        with self._lock:
+            yield self._conn
+
+    def submit(self, func, *args, **kwargs):
+        future = concurrent.futures.Future()
+        try:
+            with self.cursor() as cursor:
+                future.set_result(func(cursor, *args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+    def close(self):
+        pass
+
+
+class SharedConnection:
+    # one connection and the cursor pool over it, shared by every session of a process so the statements prepared
+    # on it outlive a rerun, and reopened when version() changes, e.g. once setup_db.py swaps in a rebuilt file.
+    # DuckDB hands every connection to a path the same database instance while one is open, so the old one is only
+    # closed, and the new one opened, once no rerun still holds it; reruns starting meanwhile wait for the new one
+
+    def __init__(self, open, version):
+        # open() returns (connection, pool)
+        self._open = open
+        self._version = version
+        self._condition = threading.Condition()
+        self._users = 0
+        self._opened = None
+
+    @contextlib.contextmanager
+    def lease(self):
+        with self._condition:
+            while True:
+                version = self._version()
+                if self._opened is not None and self._opened[0] == version:
+                    break
+                if not self._users:
+                    self.close()
+                    self._opened = (version, *self._open())
+                    break
+                self._condition.wait()
+            self._users += 1
+            _, conn, pool = self._opened
+        try:
+            yield conn, pool
+        finally:
+            with self._condition:
+                self._users -= 1
+                self._condition.notify_all()
+
+    def close(self):
+        if self._opened is not None:
+            _, conn, pool = self._opened
+            self._opened = None
+            pool.close()
+            conn.close()
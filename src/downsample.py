@@ -0,0 +1,138 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+
+
+def x_values(series):
+    if pd.api.types.is_numeric_dtype(series):
+        return series.to_numpy(dtype=float)
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series.to_numpy().astype('datetime64[ns]').astype(np.int64).astype(float)
+    # categorical axes such as year_week strings are evenly spaced
+    return np.arange(len(series), dtype=float)
+
+
+def bucket_argmax(values, edges):
+    # position of the largest value in each bucket [edges[i], edges[i + 1]) of every column, the first one on ties,
+    # for all buckets at once; edges must be strictly increasing so no bucket is empty
+    offset = edges[0]
+    values = values[offset:edges[-1]]
+    starts = edges[:-1] - offset
+    bucket = np.repeat(np.arange(len(starts)), np.diff(edges))
+    positions = np.arange(len(values)).reshape(-1, *[1] * (values.ndim - 1))
+    is_max = values == np.maximum.reduceat(values, starts, axis=0)[bucket]
+    return offset + np.minimum.reduceat(np.where(is_max, positions, len(values)), starts, axis=0)
+
+
+def bucket_means(values, edges):
+    # mean of the non-NaN values in each bucket of every column, NaN for a bucket without any
+    values = values[edges[0]:edges[-1]]
+    starts = edges[:-1] - edges[0]
+    present = ~np.isnan(values)
+    totals = np.add.reduceat(np.where(present, values, 0), starts, axis=0)
+    counts = np.add.reduceat(present, starts, axis=0, dtype=np.int64)
+    return np.where(counts > 0, totals / np.maximum(counts, 1), np.nan)
+
+
+def lttb_indices(x, y, n_out):
+    # Largest-Triangle-Three-Buckets: keeps the first and last point and, per bucket, the point that forms the largest
+    # triangle with the point kept from the previous bucket and the average of the next one. Each bucket depends on
+    # the pick before it, so the buckets are walked in order; the points of a bucket and the series are scored
+    # together. y may hold one series per column, which are all picked together and give one column of rows each
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n) if y.ndim == 1 else np.repeat(np.arange(n)[:, None], y.shape[1], axis=1)
+
+    ys = y.reshape(n, -1)
+    columns = np.arange(ys.shape[1])
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.intp)
+    avg_x, avg_y = bucket_means(x[:, None], edges)[:, 0], bucket_means(ys, edges)
+    next_x, next_y = np.append(avg_x[1:], x[-1]), np.concatenate([avg_y[1:], ys[-1:]])
+
+    selected = np.empty((n_out, ys.shape[1]), dtype=np.intp)
+    selected[0], selected[-1] = 0, n - 1
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        prev_x, prev_y = x[selected[i]], ys[selected[i], columns]
+        # a next bucket without readings leaves the triangle flat on the previous point
+        after_y = np.where(np.isnan(next_y[i]), prev_y, next_y[i])
+        area = np.abs((prev_x - next_x[i]) * (ys[start:stop] - prev_y)
+                      - (prev_x - x[start:stop, None]) * (after_y - prev_y))
+        selected[i + 1] = start + np.argmax(np.where(np.isnan(area), -1, area), axis=0)
+    return selected[:, 0] if y.ndim == 1 else selected
+
+
+def min_max_indices(y, n_out):
+    # keeps the minimum and maximum of every bucket, so no peak or trough is ever dropped; the rows of all the series
+    # when y holds one per column
+    n = len(y)
+    if n_out >= n or n_out < 4:
+        return np.arange(n)
+
+    edges = np.linspace(0, n, (n_out - 2) // 2 + 1).astype(np.intp)
+    lows = bucket_argmax(np.where(np.isnan(y), -np.inf, -y), edges)
+    highs = bucket_argmax(np.where(np.isnan(y), -np.inf, y), edges)
+    return np.unique(np.concatenate([[0, n - 1], lows.ravel(), highs.ravel()]))
+
+
+# the fewest points each method reduces a series to: LTTB keeps both ends and a point per bucket, min-max both ends
+# and the minimum and maximum of a bucket
+MIN_POINTS = {'lttb': 3, 'minmax': 4}
+# charts default to min-max: LTTB keeps the shape of a series but can pass over a bucket's extreme, even the highest
+# or lowest reading of the whole range
+DEFAULT_METHOD = 'minmax'
+
+
+def select_indices(xs, y, n_out, method):
+    if method == 'lttb':
+        return lttb_indices(xs, y, n_out)
+    return min_max_indices(y, n_out)
+
+
+def series_matrix(df, columns):
+    return np.column_stack([column_series(df, column).to_numpy(dtype=float) for column in columns])
+
+
+def combined_series(df, columns):
+    # the series scaled to their own range and averaged per row, so each one counts the same whatever its units
+    ys = series_matrix(df, columns)
+    with warnings.catch_warnings():
+        # a series or row without any readings stays NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        low, high = np.nanmin(ys, axis=0), np.nanmax(ys, axis=0)
+        scaled = (ys - low) / np.where(high > low, high - low, 1)
+        return np.nanmean(scaled, axis=1)
+
+
+def column_series(df, name):
+    # pandas frames and Arrow tables alike; only the columns downsampling looks at are converted
+    values = df[name]
+    return values if isinstance(values, pd.Series) else values.to_pandas()
+
+
+def downsample(df, x, columns, max_points, method=DEFAULT_METHOD):
+    # caps the rows of a chart frame (a pandas DataFrame or an Arrow table) at max_points; with several series each
+    # gets an equal share of the budget and the frame keeps the union of the rows they selected. When a share is
+    # too small for the method, the rows are picked from the series combined into one instead
+    if method not in MIN_POINTS:
+        raise ValueError(f'Unknown downsampling method: {method}')
+    if max_points is None or len(df) <= max_points:
+        return df
+    if max_points < MIN_POINTS[method]:
+        raise ValueError(f'max_points must be at least {MIN_POINTS[method]} for {method}, got {max_points}')
+    columns = [columns] if isinstance(columns, str) else list(columns)
+    arrow = not isinstance(df, pd.DataFrame)
+    if not column_series(df, x).is_monotonic_increasing:
+        df = df.sort_by(x) if arrow else df.sort_values(x)
+    if not arrow:
+        df = df.reset_index(drop=True)
+
+    per_column = max_points // len(columns)
+    xs = x_values(column_series(df, x))
+    if per_column < MIN_POINTS[method]:
+        rows = select_indices(xs, combined_series(df, columns), max_points, method)
+    else:
+        # every series shares the buckets, so they are picked together in one pass over a matrix of them
+        rows = np.unique(select_indices(xs, series_matrix(df, columns), per_column, method))
+    return df.take(rows) if arrow else df.iloc[rows].reset_index(drop=True)
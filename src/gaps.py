@@ -0,0 +1,55 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+# setup_db.INTERVAL_MINUTES
+SLOT = np.timedelta64(5, 'm')
+SLOTS_PER_HOUR = int(np.timedelta64(1, 'h') // SLOT)
+
+
+def as_datetime64(value, end=False):
+    # a date stands for its first slot, or its last one when it ends a range
+    if isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        value = np.datetime64(value, 's') + (np.timedelta64(1, 'D') - SLOT if end else np.timedelta64(0, 's'))
+    return np.datetime64(value, 's')
+
+
+class GapIndex:
+    # warehouse.gap_index held as sorted arrays. The runs of missing slots are disjoint, so their starts and ends are
+    # both sorted and the runs touching a range are found with two binary searches, whatever the length of the history
+
+    def __init__(self, gap_start, gap_end, missing_slots, interpolated):
+        self.gap_start = np.asarray(gap_start, dtype='datetime64[s]')
+        self.gap_end = np.asarray(gap_end, dtype='datetime64[s]')
+        self.missing_slots = np.asarray(missing_slots, dtype=np.int64)
+        self.interpolated = np.asarray(interpolated, dtype=bool)
+
+    def __len__(self):
+        return len(self.gap_start)
+
+    def bounds(self, start, end):
+        # [first, last) positions of the runs with a missing slot between start and end, both inclusive
+        first = int(np.searchsorted(self.gap_end, as_datetime64(start), side='left'))
+        last = int(np.searchsorted(self.gap_start, as_datetime64(end, end=True), side='right'))
+        return first, max(first, last)
+
+    def overlapping(self, start, end):
+        first, last = self.bounds(start, end)
+        return pd.DataFrame({
+            'gap_start': self.gap_start[first:last],
+            'gap_end': self.gap_end[first:last],
+            'missing_slots': self.missing_slots[first:last],
+            'interpolated': self.interpolated[first:last],
+        })
+
+    def missing(self, start, end, interpolated=None):
+        # missing slots between start and end, with the runs at either edge clipped to the range; interpolated=False
+        # only counts the runs too long to have been filled in
+        first, last = self.bounds(start, end)
+        starts = np.maximum(self.gap_start[first:last], as_datetime64(start))
+        ends = np.minimum(self.gap_end[first:last], as_datetime64(end, end=True))
+        slots = (ends - starts) // SLOT + 1
+        if interpolated is not None:
+            slots = slots[self.interpolated[first:last] == interpolated]
+        return int(slots.sum())
@@ -2,12 +2,43 @@ import streamlit as st
 import pandas as pd
 import duckdb as ddb
 from queries import *
+from cache import QueryCache, RangeCache, db_mtime
+from cursor_pool import CursorPool, SerialCursor, SharedConnection
+from snapshot import Snapshot
+from gaps import SLOTS_PER_HOUR
+from profiling import QueryProfiler, json_logger
 import datetime
 from datetime import datetime as dt
 import altair as alt
+import contextlib
+import os
+import tempfile
+import threading
 
 st.set_page_config(layout="wide")
 
+DB_PATH = 'gridwatch.db'
+# point at a dataset written by `setup_db.py --parquet-dataset` to query the partitioned parquet instead of gridwatch.db
+PARQUET_DATASET_DIR = os.environ.get('GRIDWATCH_PARQUET_DIR')
+# roughly the pixel width of a chart; longer series are downsampled in the query layer before they reach the browser
+CHART_POINT_BUDGET = int(os.environ.get('GRIDWATCH_CHART_POINTS', 1000))
+# point at a snapshot written by `setup_db.py --snapshot` to serve the yearly summaries from memory-mapped arrays
+SNAPSHOT_DIR = os.environ.get('GRIDWATCH_SNAPSHOT_DIR')
+# 'arrow' makes the query layer hand Arrow tables straight to the charts instead of converting results to pandas
+RESULT_FORMAT = os.environ.get('GRIDWATCH_RESULT_FORMAT', 'pandas')
+# set to a file path, or '-' for stderr, to log every dashboard query as a line of JSON
+QUERY_LOG = os.environ.get('GRIDWATCH_QUERY_LOG')
+# the diagnostics panel is hidden unless this is set or the page is opened with ?diagnostics=1
+SHOW_DIAGNOSTICS = bool(os.environ.get('GRIDWATCH_DIAGNOSTICS'))
+# DuckDB rewrites a profile file after every statement, so the shared connection only profiles rows scanned when
+# every rerun shows the diagnostics panel or the query log is on
+PROFILE_QUERIES = SHOW_DIAGNOSTICS or bool(QUERY_LOG)
+# only the selected tab runs its queries; set GRIDWATCH_EAGER_TABS=1 to go back to st.tabs, which renders them all
+LAZY_TABS = not os.environ.get('GRIDWATCH_EAGER_TABS')
+# cursors, and threads, the panel queries of a tab are spread over; by default they run one after another on the
+# app's connection, as a pool has shown no gain where it was measured (see benchmark.py panels)
+QUERY_THREADS = int(os.environ.get('GRIDWATCH_QUERY_THREADS', 1))
+
 markdown_introduction = """
 ## Introduction
 This dashboard provides a comprehensive analysis of the UK's power grid using historical electricity demand data.
@@ -36,7 +67,7 @@ def get_report_level_filters():
                              min_value=datetime.date(2011,1,1),
                              max_value=datetime.date(2024,1,1),format="YYYY-MM-DD")
     
-        max_date = st.date_input(label='Enter :orange[maximum] date for analysis', value=dt.today(),
+        max_date = st.date_input(label='Enter :orange[maximum] date for analysis', value=min(dt.today().date(), datetime.date(2024,12,31)),
                              min_value=datetime.date(2012,1,1),
                              max_value=datetime.date(2024,12,31),format="YYYY-MM-DD")
         
@@ -48,12 +79,193 @@ def get_report_level_filters():
     
     
 def preview_tables(conn):
-    option = st.selectbox("Choose a table", ('dim_datetime', 'dim_energy_output_and_flow', 'fct_gridwatch'))
+    option = st.selectbox("Choose a table", list_tables(conn))
     df = check_tbl(conn,option)
     return df
 
 
-def main(conn):
+def show_diagnostics(pool, profiler):
+    records = profiler.records(profiler.run)
+    with st.expander('Diagnostics'):
+        total = sum(record['wall_ms'] for record in records)
+        st.caption(f'{len(records)} queries, {total:.0f} ms of query time on this run')
+        st.dataframe(pd.DataFrame(
+            [{key: record[key] for key in ('query', 'source', 'wall_ms', 'rows_returned', 'rows_scanned')} for record in records]
+        ), hide_index=True)
+
+        statements = profiler.statements()
+        if statements:
+            sql = st.selectbox('Statement', list(statements), format_func=lambda sql: statements[sql])
+            st.code(sql, language='sql')
+            if st.button('EXPLAIN ANALYZE'):
+                # on a cursor of its own, or holding the connection's lock, as it switches the profiling PRAGMAs
+                with pool.cursor() as conn:
+                    st.code(explain_analyze(conn, sql))
+
+
+def fetch(pool, cache, profiler, func, *args, **kwargs):
+    # runs the query, on a pooled cursor in a worker thread when GRIDWATCH_QUERY_THREADS asks for a pool; call
+    # .result() on the returned future for the frame
+    return pool.submit(lambda cursor: profiler.call(cache, func, cursor, *args, **kwargs))
+
+
+def about_tab(pool, cache, profiler, min_date, max_date):
+    st.markdown(markdown_introduction)
+
+    col1,col2 = st.columns(2,gap="medium" )
+
+    with col1:
+        st.subheader(':orange[Tables]')
+        with pool.cursor() as conn:
+            df = preview_tables(conn)
+        st.write(df)
+
+    with col2:
+        st.subheader(':orange[Data Model]')
+        st.image("gridwatch-Page-2.drawio.png", caption = "This is data model of the UK Gridwatch dataset")
+
+
+def summaries_tab(pool, cache, profiler, min_date, max_date):
+    # the widgets and chart placeholders are laid out first so every query of the tab can be submitted at once
+    st.header("Year-on-Year Averages")
+    col1,col2 = st.columns(2,gap="medium")
+    with col1: 
+        st.subheader(f'Average electricity :orange[demand]')
+        yearly_demand_chart = st.empty()
+        st.caption("There is a downward trend in electricity demand from 2024 onwards, as shown by the x-axis (year) and y-axis (energy demand). Notably, there is a dip in demand during 2020, followed by a recovery, likely reflecting the impact of the 2020 pandemic.", help="Average electricity demand")
+
+
+    with col2:
+        st.subheader("Average :orange[energy output] by source")
+        yearly_source_chart = st.empty()
+        st.caption("There are changes in energy output trend for different energy sources. For instance, coal, gas and nuclear show a downward trend whereas energy like wind, biomass and solar show an upward trend. Significantly, source from coal showed a steep drop in 2016 likely because of the UK government sustainable-energy initiatives.", help="Average energy output")
+
+    st.header("Moving Average for Electricty :orange[Demand]")
+    window_size_demand = st.slider(':orange[Choose the rolling window size for demand]',min_value=5,max_value=50,value=28)
+    window_size_demand = window_size_demand - 1
+    demand_chart = st.empty()
+    st.caption("With the moving average applied, seasonal patterns become more apparent as electricity demand are high during the winter season and low during the summer season.", help="Electricty Demand")
+    with pool.cursor() as conn:
+        gaps = get_gap_index(conn, db_mtime(PARQUET_DATASET_DIR or DB_PATH))
+    if gaps is not None:
+        runs = gaps.overlapping(min_date, max_date)
+        long_runs = runs[~runs.interpolated]
+        st.caption(f"{len(runs)} gaps in the readings of the selected period, {gaps.missing(min_date, max_date) / SLOTS_PER_HOUR:,.1f} hours in all. "
+                   f"Gaps of up to an hour are interpolated; the {len(long_runs)} longer ones ({gaps.missing(min_date, max_date, interpolated=False) / SLOTS_PER_HOUR:,.1f} hours) stay missing, and every total scales the period they fall in up from the readings it has.",
+                   help="Data gaps")
+
+    st.header("Moving Average for Energy :orange[Output] by Source")
+    window_size_energy_mix = st.slider(':orange[Choose the rolling window size for energy mix]',min_value=5,max_value=50,value=28)
+    window_size_energy_mix = window_size_energy_mix - 1
+    energy_mix_chart = st.empty()
+    st.caption("Applying a moving average clarifies trends across energy sources. Coal shows higher seasonal variation in output, while nuclear shows lower. Wind energy, on the rise, also follows seasonal patterns.", help="Energy Output")
+
+    st.header("Energy :orange[Mix] and Carbon Intensity")
+    col1,col2 = st.columns(2,gap="medium")
+    with col1:
+        st.subheader("Monthly :orange[share] of generation by source")
+        mix_share_chart = st.empty()
+    with col2:
+        st.subheader("Daily :orange[carbon intensity] (gCO2/kWh)")
+        carbon_intensity_chart = st.empty()
+    st.caption("Shares are each source's part of the metered generation. Carbon intensity is estimated from the emission factors the warehouse was built with (`setup_db.py --emission-factors`).", help="Energy mix")
+
+    st.header("Trend of Electricity :orange[Demand] by Year, Week or Day")
+
+    option = st.selectbox(":orange[Choose the date granularity]", ('Daily', 'Weekly', 'Yearly'), index=2)
+    trend_chart = st.empty()
+
+    if option == 'Daily':
+        trend = fetch(pool, cache, profiler, daily_demand, min_date, max_date, max_points=CHART_POINT_BUDGET)
+        trend_x, trend_caption = 'date', "Total energy output grouped by day"
+    elif option == 'Weekly':
+        trend = fetch(pool, cache, profiler, weekly_demand, min_date, max_date)
+        trend_x, trend_caption = 'year_week', "Total energy output grouped by ISO week; a week the selected period cuts through only sums its selected days"
+    elif option == 'Yearly':
+        trend = fetch(pool, cache, profiler, yearly_demand, min_date, max_date)
+        trend_x, trend_caption = 'year', "Total energy output grouped by year; a year the selected period cuts through only sums its selected days"
+    yearly_demand_df = fetch(pool, cache, profiler, yearly_avg_energy_demand, min_date, max_date)
+    yearly_source_df = fetch(pool, cache, profiler, yearly_avg_energy_source_contribution, min_date, max_date)
+    demand_df = fetch(pool, cache, profiler, time_series_view_demand, window_size=window_size_demand, start_date=min_date, end_date=max_date, max_points=CHART_POINT_BUDGET)
+    energy_mix_df = fetch(pool, cache, profiler, energy_source_contribution, window_size_energy_mix,min_date, max_date, max_points=CHART_POINT_BUDGET)
+    mix_share_df = fetch(pool, cache, profiler, energy_mix_shares, min_date, max_date)
+    carbon_intensity_df = fetch(pool, cache, profiler, carbon_intensity, min_date, max_date, max_points=CHART_POINT_BUDGET)
+
+    yearly_demand_chart.line_chart(yearly_demand_df.result(), x='year', y='demand', y_label = 'Energy Demand', x_label = 'Year')
+    yearly_source_chart.line_chart(yearly_source_df.result(), x='year', y=['coal', 'nuclear', 'ccgt', 'wind', 'pumped', 'hydro', 'biomass', 'oil', 'solar', 'ocgt'], y_label = 'Energy Demand', x_label = 'Year')
+    demand_chart.line_chart(demand_df.result(), x='date',y=['da'])
+    energy_mix_chart.line_chart(energy_mix_df.result(), x='date', y=['coal', 'nuclear', 'ccgt', 'wind', 'pumped', 'hydro', 'biomass', 'oil', 'solar', 'ocgt'])
+    mix_share_chart.area_chart(mix_share_df.result(), x='date', y=ENERGY_MIX_COLUMNS, y_label='Share of generation', x_label='Month')
+    carbon_intensity_chart.line_chart(carbon_intensity_df.result(), x='date', y='carbon_intensity', y_label='gCO2/kWh', x_label='Date')
+    with trend_chart.container():
+        st.line_chart(trend.result(), x=trend_x,y='demand')
+        st.caption(trend_caption, help="Energy Output")
+
+
+def interconnectors_tab(pool, cache, profiler, min_date, max_date):
+    st.header("Import & Export of Power")
+    window_size_ict = st.slider(':orange[Choose the rolling window size for interconnectors]',min_value=5,max_value=50,value=28)
+    window_size_ict = window_size_ict - 1
+    df = fetch(pool, cache, profiler, interconnector_flows, INTERCONNECTOR_COLUMNS, window_size=window_size_ict, start=min_date, end=max_date, max_points=CHART_POINT_BUDGET).result()
+    col1,col2,col3 = st.columns(3,gap="medium" )
+    with col1:
+        st.subheader("French Interconnector")
+        st.line_chart(df, x= 'date',y='french_ict')
+    with col2:
+        st.subheader("Dutch Interconnector (BRTINED)")
+        st.line_chart(df, x= 'date',y='dutch_ict')
+    with col3:
+        st.subheader("Irish Interconnector (Moyle)")
+        st.line_chart(df, x= 'date',y='irish_ict')
+
+    with col1:
+        st.subheader("Irish Interconnector (East-West)")
+        st.line_chart(df, x= 'date',y='ew_ict')
+    with col2:
+        st.subheader("NEMO Interconnector")
+        st.line_chart(df, x= 'date',y='nemo')
+    with col3:
+        st.subheader("French Interconnector 2")
+        st.line_chart(df, x= 'date',y='french_ict_2')
+
+    with col1:
+        st.subheader("French Interconnector (INTELEC)")
+        st.line_chart(df, x= 'date',y='french_ict_intelec')
+    with col2:
+        st.subheader("Norway Interconnector")
+        st.line_chart(df, x= 'date',y='norway_ict')
+    with col3:
+        st.subheader("Viking Interconnector")
+        st.line_chart(df, x= 'date',y='vkl_ict')
+
+
+def analysis_tab(pool, cache, profiler, min_date, max_date):
+    st.markdown(markdown_analysis)
+
+    st.header("Peaks and Troughs of Electricity :orange[Demand]")
+    prominence_ratio = st.slider(':orange[Minimum prominence, as a share of the demand range]',min_value=0.02,max_value=0.5,value=0.1,step=0.02)
+    series = fetch(pool, cache, profiler, daily_demand, min_date, max_date, max_points=CHART_POINT_BUDGET)
+    events = fetch(pool, cache, profiler, demand_turning_points, min_date, max_date, prominence_ratio=prominence_ratio)
+    line = alt.Chart(series.result()).mark_line().encode(x=alt.X('date:T', title='Date'), y=alt.Y('demand:Q', title='Energy Demand'))
+    points = alt.Chart(events.result()).mark_point(filled=True, size=80).encode(
+        x='date:T', y='demand:Q', shape='kind:N', color=alt.Color('trend:N', title='Trend'),
+        tooltip=['date:T', 'kind:N', 'trend:N', alt.Tooltip('prominence:Q', format=',.0f')],
+    )
+    st.altair_chart(line + points, use_container_width=True)
+    st.caption("Peaks and troughs of the 28-day average demand. Each one is compared with the previous peak or trough: a run of lower highs and lower lows is a falling trend, higher highs and higher lows a rising one, and an equal high or low sits level with the one before.", help="Peak & trough analysis")
+
+
+TABS = {
+    ':orange[About]': about_tab,
+    'Data Summaries': summaries_tab,
+    'Interconnectors': interconnectors_tab,
+    'Data Analysis': analysis_tab,
+}
+
+
+def main(pool, cache, profiler):
+    
+    profiler.start_run()
     
     st.title(':orange[UK Gridwatch Dashboard]')
     
@@ -65,122 +277,126 @@ def main(conn):
         st.write(" :violet[Streamlit version:] " + st.__version__)
         
         st.write(" :violet[Made by:] " + "Raef Aidid")
-    
-    
-    tab1, tab2, tab3, tab4 = st.tabs([':orange[About]','Data Summaries','Interconnectors', 'Data Analysis'])
-    
-    with tab1:
-        
-        st.markdown(markdown_introduction)
         
-        col1,col2 = st.columns(2,gap="medium" )
+        cache_stats = cache.stats()
+        st.caption(f"Query cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['entries']} entries")
         
-        with col1:
-            st.subheader(':orange[Tables]')
-            df = preview_tables(conn)
-            st.write(df)
-            
-        with col2:
-            st.subheader(':orange[Data Model]')
-            st.image("gridwatch-Page-2.drawio.png", caption = "This is data model of the UK Gridwatch dataset")
+        # filled in once the tabs have run their queries
+        diagnostics = st.container()
     
-    with tab2: 
-        st.header("Year-on-Year Averages")
-        col1,col2 = st.columns(2,gap="medium")
-        with col1: 
-            st.subheader(f'Average electricity :orange[demand]')
-            df = yearly_avg_energy_demand(conn, min_date, max_date)
-            st.line_chart(df, x='year', y='demand', y_label = 'Energy Demand', x_label = 'Year')
-            st.caption("There is a downward trend in electricity demand from 2024 onwards, as shown by the x-axis (year) and y-axis (energy demand). Notably, there is a dip in demand during 2020, followed by a recovery, likely reflecting the impact of the 2020 pandemic.", help="Average electricity demand")
-            
-            
-        with col2:
-            st.subheader("Average :orange[energy output] by source")
-            df = yearly_avg_energy_source_contribution(conn, min_date, max_date)
-            st.line_chart(df, x='year', y=['coal', 'nuclear', 'ccgt', 'wind', 'pumped', 'hydro', 'biomass', 'oil', 'solar', 'ocgt'], y_label = 'Energy Demand', x_label = 'Year')
-            st.caption("There are changes in energy output trend for different energy sources. For instance, coal, gas and nuclear show a downward trend whereas energy like wind, biomass and solar show an upward trend. Significantly, source from coal showed a steep drop in 2016 likely because of the UK government sustainable-energy initiatives.", help="Average energy output")
-             
-        st.header("Moving Average for Electricty :orange[Demand]")
-        window_size_demand = st.slider(':orange[Choose the rolling window size for demand]',min_value=5,max_value=50,value=28)
-        window_size_demand = window_size_demand - 1
-        df = time_series_view_demand(conn,window_size=window_size_demand, start_date=min_date, end_date=max_date)
-        st.line_chart(df, x='date',y=['da'])
-        st.caption("With the moving average applied, seasonal patterns become more apparent as electricity demand are high during the winter season and low during the summer season.", help="Electricty Demand")
-        
-        st.header("Moving Average for Energy :orange[Output] by Source")
-        window_size_energy_mix = st.slider(':orange[Choose the rolling window size for energy mix]',min_value=5,max_value=50,value=28)
-        window_size_energy_mix = window_size_energy_mix - 1
-        df = energy_source_contribution(conn, window_size_energy_mix,min_date, max_date)
-        st.line_chart(df, x='date', y=['coal', 'nuclear', 'ccgt', 'wind', 'pumped', 'hydro', 'biomass', 'oil', 'solar', 'ocgt'])
-        st.caption("Applying a moving average clarifies trends across energy sources. Coal shows higher seasonal variation in output, while nuclear shows lower. Wind energy, on the rise, also follows seasonal patterns.", help="Energy Output")
-        
-        st.header("Trend of Electricity :orange[Demand] by Year, Week or Day")
-        
-        option = st.selectbox(":orange[Choose the date granularity]", ('Daily', 'Weekly', 'Yearly'), index=2)
-        
-        if option == 'Daily':
-            df = daily_demand(conn, min_date, max_date)
-            st.line_chart(df, x='date',y='demand')
-            st.caption("Total energy output grouped by day", help="Energy Output")
-        elif option == 'Weekly':
-            df = weekly_demand(conn, min_date, max_date)
-            st.line_chart(df, x='year_week',y='demand')
-            st.caption("Total energy output grouped by ISO week", help="Energy Output")
-        elif option == 'Yearly':
-            df = yearly_demand(conn, min_date, max_date)
-            st.line_chart(df, x='year',y='demand')
-            st.caption("Total energy output grouped by year", help="Energy Output")
-        
-    with tab3:
-        st.header("Import & Export of Power")
-        window_size_ict = st.slider(':orange[Choose the rolling window size for interconnectors]',min_value=5,max_value=50,value=28)
-        window_size_ict = window_size_ict - 1
-        col1,col2,col3 = st.columns(3,gap="medium" )
-        with col1:
-            st.subheader("French Interconnector")
-            df = french_interconnector(conn, window_size= window_size_ict,start_date=min_date, end_date=max_date)
-            st.line_chart(df, x= 'date',y='french_ict')
-        with col2:
-            st.subheader("Dutch Interconnector (BRTINED)")
-            df = dutch_interconnector(conn, window_size= window_size_ict,start_date=min_date, end_date=max_date)
-            st.line_chart(df, x= 'date',y='dutch_ict')
-        with col3:
-            st.subheader("Irish Interconnector (Moyle)")
-            df = irish_interconnector(conn, window_size= window_size_ict,start_date=min_date, end_date=max_date)
-            st.line_chart(df, x= 'date',y='irish_ict')
-        
-        with col1:
-            st.subheader("Irish Interconnector (East-West)")
-            df = ew_interconnector(conn, window_size= window_size_ict,start_date=min_date, end_date=max_date)
-            st.line_chart(df, x= 'date',y='ew_ict')
-        with col2:
-            st.subheader("NEMO Interconnector")
-            df = nemo_interconnector(conn, window_size= window_size_ict,start_date=min_date, end_date=max_date)
-            st.line_chart(df, x= 'date',y='nemo')
-        with col3:
-            st.subheader("French Interconnector 2")
-            df = french_interconnector_two(conn, window_size= window_size_ict,start_date=min_date, end_date=max_date)
-            st.line_chart(df, x= 'date',y='french_ict_2')
-            
-        with col1:
-            st.subheader("French Interconnector (INTELEC)")
-            df = french_interconnector_intelec(conn, window_size= window_size_ict,start_date=min_date, end_date=max_date)
-            st.line_chart(df, x= 'date',y='french_ict_intelec')
-        with col2:
-            st.subheader("Norway Interconnector")
-            df = norway_interconnector(conn, window_size= window_size_ict,start_date=min_date, end_date=max_date)
-            st.line_chart(df, x= 'date',y='norway_ict')
-        with col3:
-            st.subheader("Viking Interconnector")
-            df = viking_interconnector(conn, window_size= window_size_ict,start_date=min_date, end_date=max_date)
-            st.line_chart(df, x= 'date',y='vkl_ict')
-        
-        
-        
-    with tab4:
-        st.markdown(markdown_analysis)
-            
+    if LAZY_TABS:
+        # st.tabs renders every tab on each rerun, so pick the tab with a radio and render only that one
+        selected = st.radio('Tab', list(TABS), horizontal=True, label_visibility='collapsed', key='tab')
+        TABS[selected](pool, cache, profiler, min_date, max_date)
+    else:
+        for tab, render in zip(st.tabs(list(TABS)), TABS.values()):
+            with tab:
+                render(pool, cache, profiler, min_date, max_date)
+    
+    if diagnostics_shown():
+        with diagnostics:
+            show_diagnostics(pool, profiler)
+
+
+def diagnostics_shown():
+    return SHOW_DIAGNOSTICS or st.query_params.get('diagnostics') == '1'
+
+
+def open_connection(profile=False):
+    if PARQUET_DATASET_DIR:
+        conn = ddb.connect()
+        attach_parquet_warehouse(conn, PARQUET_DATASET_DIR)
+    else:
+        conn = ddb.connect(DB_PATH, read_only=True)
+    if profile:
+        enable_profiling(conn, profile_output(f'main_{threading.get_ident()}'))
+    return conn
+
+
+def profile_output(name):
+    return os.path.join(tempfile.gettempdir(), f'gridwatch_profile_{os.getpid()}_{name}.json')
+
+
+def open_cursor_pool(conn, profile=False):
+    if QUERY_THREADS <= 1:
+        return SerialCursor(conn)
+    setup = (lambda cursor, index: enable_profiling(cursor, profile_output(f'{threading.get_ident()}_{index}'))) if profile else None
+    return CursorPool(conn, QUERY_THREADS, setup=setup)
+
+
+@st.cache_resource
+def get_shared_connection():
+    # held across reruns, as opening the database costs more than the queries of a rerun and would throw away the
+    # statements prepared on it; setup_db.py swaps a rebuilt file in by rename, and the next rerun reopens it
+    def open():
+        conn = open_connection(PROFILE_QUERIES)
+        return conn, open_cursor_pool(conn, PROFILE_QUERIES)
+    return SharedConnection(open, lambda: db_mtime(PARQUET_DATASET_DIR or DB_PATH))
+
+
+@contextlib.contextmanager
+def rerun_connection():
+    # the connection and pool a rerun queries through, leased so the shared connection is not reopened under it
+    with get_shared_connection().lease() as (conn, pool):
+        if PROFILE_QUERIES or not diagnostics_shown():
+            yield conn, pool
+            return
+        # ?diagnostics=1 on a process that does not profile: this rerun queries through a profiled cursor of its own
+        cursor = conn.cursor()
+        enable_profiling(cursor, profile_output(f'main_{threading.get_ident()}'))
+        pool = open_cursor_pool(cursor, profile=True)
+        try:
+            yield cursor, pool
+        finally:
+            pool.close()
+            cursor.close()
+
+
+@st.cache_resource
+def get_query_cache():
+    # one cache per server process, shared by every session and invalidated when gridwatch.db is rebuilt
+    return QueryCache(PARQUET_DATASET_DIR or DB_PATH, max_bytes=256 * 1024 * 1024)
+
+
+@st.cache_resource
+def get_range_cache():
+    # the last range of each rolling query, so dragging the date slider only recomputes the days it uncovers
+    return RangeCache(PARQUET_DATASET_DIR or DB_PATH)
+
+
+@st.cache_resource
+def get_snapshot(_conn, db_version):
+    # mapped once per process and version of the database; the pages themselves are shared with every other process
+    # mapping the files. A snapshot not written from the warehouse as it is now, e.g. one left behind by
+    # `setup_db.py --incremental` without --snapshot, is not used and the summaries come from SQL
+    if not SNAPSHOT_DIR:
+        return None
+    snapshot = Snapshot(SNAPSHOT_DIR)
+    return snapshot if snapshot.matches(_conn) else None
+
+
+@st.cache_resource
+def get_gap_index(_conn, db_version):
+    # loaded once per process and version of the database, so a rebuild or incremental load shows its own gaps;
+    # the gaps of a date range are then two binary searches away
+    return load_gap_index(_conn)
+
+
+@st.cache_resource
+def get_query_logger():
+    return json_logger(QUERY_LOG) if QUERY_LOG else None
+
+
+def get_profiler():
+    # one per browser session, so the diagnostics panel only lists that session's queries
+    if 'profiler' not in st.session_state:
+        st.session_state.profiler = QueryProfiler(logger=get_query_logger())
+    return st.session_state.profiler
+
+
 if __name__ == '__main__':
-    with ddb.connect('gridwatch.db', read_only=True) as conn:
-        main(conn)
-    
\ No newline at end of file
+    with rerun_connection() as (conn, pool):
+        use_snapshot(get_snapshot(conn, db_mtime(PARQUET_DATASET_DIR or DB_PATH)))
+        use_range_cache(get_range_cache())
+        use_result_format(RESULT_FORMAT)
+        main(pool, get_query_cache(), get_profiler())
@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+
+
+def turning_points(y):
+    # indices of the local maxima and minima of y, in order; the first and last points count as both so every
+    # peak has a trough on either side. Plateaus are reduced to their first point
+    n = len(y)
+    if n < 3:
+        return np.arange(n)
+    keep = np.concatenate([[True], np.diff(y) != 0])
+    index = np.flatnonzero(keep)
+    values = y[index]
+    slope = np.sign(np.diff(values))
+    turns = np.flatnonzero(slope[1:] != slope[:-1]) + 1
+    return np.unique(np.concatenate([[0], index[turns], [n - 1]]))
+
+
+def sparse_table(values, reduce, fill):
+    # row k holds reduce over values[i:i + 2**k] at column i, padded with fill where the window runs off the end
+    n = len(values)
+    table = [values]
+    width = 1
+    while 2 * width <= n:
+        row = table[-1]
+        table.append(np.concatenate([reduce(row[:n - width], row[width:]), np.full(width, fill)]))
+        width *= 2
+    return np.stack(table)
+
+
+def left_bases(values):
+    # for every point, the lowest value between it and the nearest strictly higher point on its left (or the start
+    # of the series), itself included. The nearest higher point is found for all points at once by binary lifting
+    # over a sparse table of window maxima, and the lowest value is a range minimum over another; both take
+    # log2(n) array passes instead of a Python loop per point
+    n = len(values)
+    highs, lows = sparse_table(values, np.maximum, np.inf), sparse_table(values, np.minimum, np.inf)
+    index = np.arange(n)
+    # the leftmost start from which nothing up to the point is higher than it
+    start = index.copy()
+    for level in range(len(highs) - 1, -1, -1):
+        step = start - 2 ** level
+        within = (step >= 0) & (highs[level, np.maximum(step, 0)] <= values)
+        start = np.where(within, step, start)
+    level = np.floor(np.log2(index - start + 1)).astype(np.intp)
+    return np.minimum(lows[level, start], lows[level, index - 2 ** level + 1])
+
+
+def prominences(values):
+    # prominence of every point of an alternating max/min sequence: its height above the higher of the two lowest
+    # points between it and the nearest higher point on each side (or the series edge)
+    values = np.asarray(values, dtype=float)
+    if not len(values):
+        return values
+    return values - np.maximum(left_bases(values), left_bases(values[::-1])[::-1])
+
+
+def classify(values):
+    # compares every event with the previous one of the same kind; one level with it, such as a flat double top,
+    # is 'equal'
+    trend = np.full(len(values), None, dtype=object)
+    if len(values) > 1:
+        change = np.diff(values)
+        trend[1:] = np.where(change > 0, 'higher', np.where(change < 0, 'lower', 'equal'))
+    return trend
+
+
+def detect_peaks(df, x, column, min_prominence=None, prominence_ratio=0.1):
+    # peaks and troughs of df[column] at least min_prominence tall, by default prominence_ratio of the series range,
+    # each labelled higher_/lower_/equal_high or higher_/lower_/equal_low against the previous event of its kind
+    if not isinstance(df, pd.DataFrame):
+        df = df.select([x, column]).to_pandas(date_as_object=False)
+    df = df[[x, column]].dropna().reset_index(drop=True)
+    y = df[column].to_numpy(dtype=float)
+    if min_prominence is None:
+        min_prominence = prominence_ratio * (y.max() - y.min()) if len(y) else 0
+
+    candidates = turning_points(y)
+    events = []
+    for kind, sign, suffix in (('peak', 1, 'high'), ('trough', -1, 'low')):
+        prominence = prominences(sign * y[candidates])
+        # the ends of the series are only there as bases, they are never reported
+        significant = (prominence >= min_prominence) & (prominence > 0) & (candidates > 0) & (candidates < len(y) - 1)
+        picked = candidates[significant]
+        events.append(pd.DataFrame({
+            x: df[x].to_numpy()[picked],
+            column: y[picked],
+            'kind': kind,
+            'prominence': prominence[significant],
+            'trend': [f'{trend}_{suffix}' if trend else None for trend in classify(y[picked])],
+        }))
+    return pd.concat(events, ignore_index=True).sort_values(x, ignore_index=True)
@@ -0,0 +1,90 @@
+import collections
+import inspect
+import json
+import logging
+import sys
+import threading
+import time
+
+import queries
+from cache import normalize_param
+
+
+def json_logger(path):
+    # one JSON object per line, to a file or to stderr with '-'
+    logger = logging.getLogger('gridwatch.queries')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = logging.StreamHandler(sys.stderr) if path == '-' else logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    return logger
+
+
+class QueryProfiler:
+    # records wall time, rows returned and rows scanned for every dashboard query. The SQL statements a
+    # call runs are captured by queries.run_query and its snapshot reads by queries.snapshot_result; a call that
+    # makes neither was answered by the cache
+
+    def __init__(self, max_records=500, logger=None):
+        self.logger = logger
+        self.run = 0
+        self._records = collections.deque(maxlen=max_records)
+        self._lock = threading.Lock()
+
+    def start_run(self):
+        with self._lock:
+            self.run += 1
+
+    def call(self, cache, func, conn, *args, **kwargs):
+        bound = inspect.signature(func).bind(conn, *args, **kwargs)
+        params = {name: normalize_param(value) for name, value in bound.arguments.items() if name != 'conn'}
+
+        outer = getattr(queries._statement_log, 'statements', None)
+        outer_reads = getattr(queries._statement_log, 'snapshot_reads', None)
+        queries._statement_log.statements = statements = []
+        queries._statement_log.snapshot_reads = snapshot_reads = []
+        started = time.perf_counter()
+        try:
+            result = cache.call(func, conn, *args, **kwargs) if cache is not None else func(conn, *args, **kwargs)
+        finally:
+            queries._statement_log.statements = outer
+            queries._statement_log.snapshot_reads = outer_reads
+        wall = time.perf_counter() - started
+        if outer is not None:
+            outer.extend(statements)
+        if outer_reads is not None:
+            outer_reads.extend(snapshot_reads)
+
+        scanned = [statement['rows_scanned'] for statement in statements]
+        record = {
+            'run': self.run,
+            'query': func.__name__,
+            'params': params,
+            'wall_ms': round(wall * 1000, 3),
+            'rows_returned': len(result),
+            'rows_scanned': sum(scanned) if statements and None not in scanned else None,
+            'cached': not statements and not snapshot_reads,
+            'source': 'duckdb' if statements else 'snapshot' if snapshot_reads else 'cache',
+            'statements': [
+                {'sql': statement['sql'], 'ms': round(statement['seconds'] * 1000, 3), 'rows_scanned': statement['rows_scanned']}
+                for statement in statements
+            ],
+        }
+        with self._lock:
+            self._records.append(record)
+        if self.logger is not None:
+            self.logger.info(json.dumps(record, default=str))
+        return result
+
+    def records(self, run=None):
+        with self._lock:
+            return [record for record in self._records if run is None or record['run'] == run]
+
+    def statements(self):
+        # distinct SQL seen so far, newest first, for EXPLAIN ANALYZE
+        seen = {}
+        for record in reversed(self.records()):
+            for statement in record['statements']:
+                seen.setdefault(statement['sql'], record['query'])
+        return seen
@@ -1,4 +1,316 @@
+import datetime
+import hashlib
+import json
+import math
+import numbers
+import os
+import threading
+import time
+import weakref
+
 import duckdb as dd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+from downsample import column_series, downsample
+from gaps import GapIndex
+from peaks import detect_peaks
+
+ENERGY_MIX_COLUMNS = ['coal', 'nuclear', 'ccgt', 'wind', 'pumped', 'hydro', 'biomass', 'oil', 'solar', 'ocgt']
+ROLLING_STATISTICS = {'mean': 'AVG', 'median': 'MEDIAN', 'std': 'STDDEV_SAMP', 'min': 'MIN', 'max': 'MAX'}
+# the start of the period each row of a finer grain table falls in; weeks are ISO weeks starting on Monday
+GRAIN_PERIODS = {
+    'hour': 'hour',
+    'day': 'date',
+    'week': "date_trunc('week', date)",
+    'month': "date_trunc('month', date)",
+    'year': "date_trunc('year', date)",
+}
+# the grain pyramid built by setup_db.py, finest first; every table has one row per period starting at `date`
+GRAIN_TABLES = {
+    'hour': 'agg_hourly',
+    'day': 'agg_daily',
+    'week': 'agg_weekly',
+    'month': 'agg_monthly',
+    'year': 'agg_yearly',
+}
+# tables whose periods nest inside each grain, coarsest first; weeks straddle month and year boundaries
+GRAIN_SOURCES = {
+    'hour': ['hour'],
+    'day': ['day', 'hour'],
+    'week': ['week', 'day', 'hour'],
+    'month': ['month', 'day', 'hour'],
+    'year': ['year', 'month', 'day', 'hour'],
+}
+WINDOW_FRAMES = {
+    'rows': 'ROWS BETWEEN $1 PRECEDING AND CURRENT ROW',
+    'range': 'RANGE BETWEEN {periods}($1) PRECEDING AND CURRENT ROW',
+}
+# a 'range' window reaches back window_size periods of its grain in time, so missing periods shorten it; only the
+# grains of a fixed length have one
+RANGE_PERIODS = {'hour': ('to_hours', datetime.timedelta(hours=1)), 'day': ('to_days', datetime.timedelta(days=1))}
+INTERCONNECTOR_COLUMNS = ['french_ict', 'dutch_ict', 'irish_ict', 'ew_ict', 'nemo', 'french_ict_2', 'french_ict_intelec', 'norway_ict', 'vkl_ict']
+
+# names of the statements already prepared on each connection, dropped together with the connection
+_prepared_statements = weakref.WeakKeyDictionary()
+# file DuckDB writes the JSON profile of the last statement to, per connection with profiling enabled
+_profile_outputs = weakref.WeakKeyDictionary()
+# statements run, and snapshot reads made, on this thread while profiling.QueryProfiler is recording a call
+_statement_log = threading.local()
+# what run_query returns: 'pandas' DataFrames or 'arrow' tables, which skip the conversion to pandas, see use_result_format
+_result_format = 'pandas'
+# memory-mapped snapshot.Snapshot the yearly and monthly summaries are served from when set, see use_snapshot
+_snapshot = None
+# warehouse tables per connection, looked up once
+_warehouse_tables = weakref.WeakKeyDictionary()
+# cache.RangeCache of the last range each rolling query was computed over when set, see use_range_cache
+_range_cache = None
+# columns every rolling_stats call computes in one scan when set, with the last such result, see share_rolling_scans
+_shared_rolling_columns = None
+_shared_rolling_result = None
+
+
+def statement_name(query):
+    return 'q_' + hashlib.sha1(query.encode()).hexdigest()[:16]
+
+
+def sql_literal(value):
+    if isinstance(value, bool) or value is None:
+        raise TypeError(f'Unsupported query parameter: {value!r}')
+    if isinstance(value, datetime.datetime):
+        return f"TIMESTAMP '{value.isoformat(sep=' ')}'"
+    if isinstance(value, datetime.date):
+        return f"DATE '{value.isoformat()}'"
+    if isinstance(value, numbers.Integral):
+        return str(int(value))
+    if isinstance(value, numbers.Real):
+        return repr(float(value))
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    raise TypeError(f'Unsupported query parameter: {value!r}')
+
+
+def render_query(query, params):
+    # inline the parameters, highest position first so $1 never clobbers $10
+    for position in range(len(params), 0, -1):
+        query = query.replace(f'${position}', sql_literal(params[position - 1]))
+    return query
+
+
+def run_query(conn, query, params=()):
+    # DuckDB only accepts literals in EXECUTE, so the (cheap) EXECUTE statement is rendered
+    # while the query itself is parsed and planned once per connection
+    prepared = _prepared_statements.setdefault(conn, set())
+    name = statement_name(query)
+    if name not in prepared:
+        conn.sql(f'PREPARE {name} AS {query}')
+        prepared.add(name)
+
+    arguments = ', '.join(sql_literal(param) for param in params)
+    started = time.perf_counter()
+    result = conn.execute(f'EXECUTE {name}({arguments})' if params else f'EXECUTE {name}')
+    df = result.arrow() if _result_format == 'arrow' else result.fetchdf()
+    log = getattr(_statement_log, 'statements', None)
+    if log is not None:
+        profile = last_profile(conn)
+        log.append({
+            'sql': render_query(query, params),
+            'seconds': time.perf_counter() - started,
+            'rows_returned': len(df),
+            'rows_scanned': profile['cumulative_rows_scanned'] if profile else None,
+        })
+    return df
+
+
+def use_result_format(result_format):
+    global _result_format
+    if result_format not in ('pandas', 'arrow'):
+        raise ValueError(f'Unknown result format: {result_format}')
+    _result_format = result_format
+
+
+def rename_columns(df, mapping):
+    if isinstance(df, pd.DataFrame):
+        return df.rename(columns=mapping)
+    return df.rename_columns({name: mapping.get(name, name) for name in df.column_names})
+
+
+def set_column(df, name, values):
+    # a new frame, so a cached one is never modified
+    if isinstance(df, pd.DataFrame):
+        return df.assign(**{name: values})
+    return df.append_column(name, pa.array(values))
+
+
+def drop_columns(df, names):
+    if isinstance(df, pd.DataFrame):
+        return df.drop(columns=names)
+    return df.drop_columns(names)
+
+
+def date_values(df):
+    # the date column as datetime64, whether it came back as pandas datetimes or as Arrow dates or timestamps
+    if isinstance(df, pd.DataFrame):
+        return df['date'].to_numpy(dtype='datetime64[ns]')
+    return df['date'].cast(pa.timestamp('ns')).to_numpy()
+
+
+def rows_between(df, low=None, high=None):
+    # the rows dated in [low, high), for a frame sorted by date
+    dates = date_values(df)
+    start = int(np.searchsorted(dates, low)) if low is not None else 0
+    stop = int(np.searchsorted(dates, high)) if high is not None else len(dates)
+    if isinstance(df, pd.DataFrame):
+        return df.iloc[start:stop]
+    return df.slice(start, max(stop - start, 0))
+
+
+def concat_frames(frames):
+    if isinstance(frames[0], pd.DataFrame):
+        return pd.concat(frames, ignore_index=True)
+    return pa.concat_tables(frames)
+
+
+def enable_profiling(conn, path):
+    # DuckDB rewrites the JSON file after every statement for run_query to read back, so only turn this on while
+    # something reads rows_scanned; without it they are None
+    conn.execute("PRAGMA enable_profiling = 'json'")
+    conn.execute(f"PRAGMA profiling_output = '{path}'")
+    _profile_outputs[conn] = path
+
+
+def last_profile(conn):
+    path = _profile_outputs.get(conn)
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def explain_analyze(conn, query):
+    # the JSON profile format would also apply to EXPLAIN ANALYZE, so switch to the text tree for this statement
+    if conn not in _profile_outputs:
+        return conn.execute(f'EXPLAIN ANALYZE {query}').fetchall()[0][1]
+    conn.execute("PRAGMA enable_profiling = 'query_tree'")
+    try:
+        return conn.execute(f'EXPLAIN ANALYZE {query}').fetchall()[0][1]
+    finally:
+        conn.execute("PRAGMA enable_profiling = 'json'")
+
+
+def date_filter(start, end):
+    # the year/month predicate is redundant on the DuckDB tables but lets hive-partitioned parquet skip whole partitions
+    return (
+        f'date BETWEEN {start} AND {end} '
+        f'AND year * 100 + month BETWEEN YEAR({start}) * 100 + MONTH({start}) AND YEAR({end}) * 100 + MONTH({end})'
+    )
+
+
+def attach_parquet_warehouse(conn, dataset_dir):
+    # exposes a dataset written by `setup_db.py --parquet-dataset` as warehouse.<table> views
+    conn.execute('CREATE SCHEMA IF NOT EXISTS warehouse')
+    for entry in sorted(os.listdir(dataset_dir)):
+        path = os.path.join(dataset_dir, entry)
+        if os.path.isdir(path):
+            table_name, source = entry, f"read_parquet('{path}/*/*/*.parquet', hive_partitioning = true)"
+        elif entry.endswith('.parquet'):
+            table_name, source = entry[:-len('.parquet')], f"read_parquet('{path}')"
+        else:
+            continue
+        conn.execute(f'CREATE OR REPLACE VIEW warehouse.{table_name} AS SELECT * FROM {source}')
+
+
+def use_range_cache(range_cache):
+    global _range_cache
+    _range_cache = range_cache
+
+
+def share_rolling_scans(columns):
+    # for batch runs in one thread (see report.py): a rolling_stats call on any of columns computes all of them
+    # and keeps the result, so the next calls over the same range, window and statistics only pick their columns
+    global _shared_rolling_columns, _shared_rolling_result
+    _shared_rolling_columns = list(columns) if columns else None
+    _shared_rolling_result = None
+
+
+def rolling_stats_columns(columns, statistics):
+    # the columns rolling_stats returns, in order
+    names = ['date']
+    for column in columns:
+        if 'value' in statistics:
+            names.append(f'{column}_value')
+        names.extend(f'{column}_{statistic}' for statistic in statistics if statistic in ROLLING_STATISTICS)
+    if 'ewma' in statistics:
+        names.extend(f'{column}_ewma' for column in columns)
+    return names
+
+
+def select_columns(df, names):
+    if isinstance(df, pd.DataFrame):
+        return df[names]
+    return df.select(names)
+
+
+def use_snapshot(snapshot):
+    global _snapshot
+    _snapshot = snapshot
+
+
+def snapshot_covers(*dates):
+    return _snapshot is not None and all(isinstance(day, datetime.date) for day in dates)
+
+
+def snapshot_result(df):
+    # a summary computed from the snapshot, in the result format and noted for profiling.QueryProfiler
+    reads = getattr(_statement_log, 'snapshot_reads', None)
+    if reads is not None:
+        reads.append(len(df))
+    return pa.Table.from_pandas(df, preserve_index=False) if _result_format == 'arrow' else df
+
+
+def period_start(grain, day):
+    if grain == 'week':
+        return day - datetime.timedelta(days=day.weekday())
+    if grain == 'month':
+        return day.replace(day=1)
+    if grain == 'year':
+        return day.replace(month=1, day=1)
+    return day
+
+
+def grain_source(conn, grain, start_date, end_date):
+    # the coarsest table that can answer `grain` over [start_date, end_date] with whole periods only, so a
+    # zoomed-out chart reads a few hundred pre-aggregated rows; ranges cutting through a period fall back to finer tables
+    if conn not in _warehouse_tables:
+        _warehouse_tables[conn] = set(list_tables(conn))
+    available = _warehouse_tables[conn]
+    dates = isinstance(start_date, datetime.date) and isinstance(end_date, datetime.date)
+
+    for source in GRAIN_SOURCES.get(grain, []):
+        if GRAIN_TABLES[source] not in available:
+            continue
+        if source in ('hour', 'day'):
+            return source
+        after_end = end_date + datetime.timedelta(days=1) if dates else None
+        if dates and period_start(source, start_date) == start_date and period_start(source, after_end) == after_end:
+            return source
+    return 'day'
+
+
+def list_tables(conn):
+    df = conn.sql("SELECT table_name FROM information_schema.tables WHERE table_schema = 'warehouse' ORDER BY 1").fetchdf()
+    return df.table_name.tolist()
+
+
+def load_gap_index(conn):
+    # None for a warehouse built before the gap index existed, or a parquet dataset, which does not carry it
+    if 'gap_index' not in list_tables(conn):
+        return None
+    df = conn.sql('SELECT gap_start, gap_end, missing_slots, interpolated FROM warehouse.gap_index ORDER BY gap_start').fetchnumpy()
+    return GapIndex(df['gap_start'], df['gap_end'], df['missing_slots'], df['interpolated'])
+
 
 def check_db(conn):
     df = conn.sql('SHOW ALL TABLES').fetchdf()
@@ -15,507 +327,467 @@ def check_fct_tbl(conn):
     return df
 
 
-def time_series_view_demand(conn, window_size, start_date, end_date):
-    
-    query = f"""
-    
-    with base_tbl as (
-    SELECT 
-        dt.timestamp::date as date,
-        SUM(eof.demand) as d
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id 
-    WHERE dt.timestamp::date BETWEEN '{start_date}::date' AND '{end_date}::date'
-    GROUP BY 1
+def windowed_statistics(statistics):
+    return any(statistic in ROLLING_STATISTICS for statistic in statistics)
+
+
+def window_frame(window, grain):
+    return WINDOW_FRAMES[window].format(periods=RANGE_PERIODS[grain][0] if window == 'range' else None)
+
+
+def period_total(column, rolled_up=True):
+    # a period's total of column, scaled up over the slots missing inside it (an outage too long to interpolate): the
+    # mean of the slots with a reading times the period's slots on the spine, stored per row by setup_db.py. Only the
+    # rows within the date range are summed, so a period the range cuts through is the partial total of its days
+    if rolled_up:
+        return f'SUM({column}_sum) / NULLIF(SUM({column}_count), 0) * SUM(slots)'
+    return f'{column}_sum / NULLIF({column}_count, 0) * slots'
+
+
+def rolling_stats_query(columns, grain, window, statistics, source='day'):
+    unknown = set(statistics) - set(ROLLING_STATISTICS) - {'value', 'ewma'}
+    if unknown:
+        raise ValueError(f'Unknown rolling statistics: {sorted(unknown)}')
+    if grain not in GRAIN_PERIODS:
+        raise ValueError(f'Unknown grain: {grain}')
+    if window not in WINDOW_FRAMES:
+        raise ValueError(f'Unknown window type: {window}')
+    if window == 'range' and grain not in RANGE_PERIODS:
+        raise ValueError(f"Range windows need a grain of fixed length ({sorted(RANGE_PERIODS)}), got {grain}; use window='rows'")
+
+    # the bucket totals, one row per period; a table of the requested grain is read as is
+    period = GRAIN_PERIODS[grain]
+    rolled_up = source != grain
+    series = ',\n        '.join(f'({period_total(column, rolled_up)})::DOUBLE as {column}' for column in columns)
+    group_by = 'GROUP BY 1' if rolled_up else ''
+
+    outputs = []
+    for column in columns:
+        if 'value' in statistics or 'ewma' in statistics:
+            outputs.append(f'{column} as {column}_value')
+        outputs.extend(
+            f'{ROLLING_STATISTICS[statistic]}({column}) OVER w as {column}_{statistic}'
+            for statistic in statistics if statistic in ROLLING_STATISTICS
+        )
+    outputs = ',\n        '.join(outputs)
+    # without a windowed statistic there is no frame, and no $1 for the window size
+    windowed = windowed_statistics(statistics)
+
+    return f"""
+    WITH series AS (
+    SELECT
+        {period} as date,
+        {series}
+    FROM warehouse.{GRAIN_TABLES[source]}
+    WHERE {date_filter('$2', '$3') if windowed else date_filter('$1', '$2')}
+    {group_by}
     )
     SELECT
         date,
-        avg(d) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as da
-    FROM base_tbl
+        {outputs}
+    FROM series
+    {f'WINDOW w AS (ORDER BY date {window_frame(window, grain)})' if windowed else ''}
+    ORDER BY date
     """
-    
-    df = conn.sql(query).fetchdf()
-    return df
 
 
-def five_days_rolling_average_demand_by_year(conn,year, window_size):
-    
-    query = f"""
-    
-    with base_tbl as (
-    SELECT 
-        dt.timestamp::date as date,
-        SUM(eof.demand) as d
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id    
-    WHERE dt.year ={year}
-    GROUP BY 1
-    )
-    SELECT
-        date,
-        d,
-        avg(d) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as da
-    FROM base_tbl
+def run_rolling_stats(conn, columns, window_size, start_date, end_date, grain, window, statistics):
+    query = rolling_stats_query(columns, grain, window, statistics, grain_source(conn, grain, start_date, end_date))
+    params = [window_size, start_date, end_date] if windowed_statistics(statistics) else [start_date, end_date]
+    return run_query(conn, query, params)
+
+
+def splice_rolling_stats(conn, columns, window_size, start_date, end_date, grain, window, statistics, previous):
+    # every window only looks back, so after a change of range the rows of the old range keep their values except
+    # the first ones after a moved start, whose windows now see different history. Those are recomputed, and so are
+    # the rows past the old end together with the warm-up rows their windows need. None when so little of the old
+    # range is left that recomputing the whole range is as cheap
+    cached_start, cached_end, cached = previous
+    one_day = datetime.timedelta(days=1)
+    overlap_start, overlap_end = max(start_date, cached_start), min(end_date, cached_end)
+    if overlap_start > overlap_end:
+        return None
+    dates = date_values(cached)
+    first = int(np.searchsorted(dates, np.datetime64(overlap_start)))
+    stop = int(np.searchsorted(dates, np.datetime64(overlap_end + one_day)))
+
+    keep_from = first
+    if start_date != cached_start:
+        if window == 'rows':
+            keep_from = first + window_size
+        else:
+            keep_from = int(np.searchsorted(dates, np.datetime64(overlap_start) + np.timedelta64(window_size * RANGE_PERIODS[grain][1])))
+    if keep_from >= stop:
+        return None
+
+    frames = []
+    if keep_from > first or start_date < cached_start:
+        # up to and including the day of the first reused row, which is dropped again
+        head = run_rolling_stats(conn, columns, window_size, start_date, pd.Timestamp(dates[keep_from]).date(), grain, window, statistics)
+        frames.append(rows_between(head, high=dates[keep_from]))
+    frames.append(rows_between(cached, dates[keep_from], np.datetime64(overlap_end + one_day)))
+    if end_date > cached_end:
+        if window == 'rows':
+            # the window_size rows before the old end, or as many as the new range has
+            warm = stop - window_size
+            if warm < first:
+                warm_up = start_date
+            elif warm == stop:
+                warm_up = cached_end + one_day
+            else:
+                warm_up = pd.Timestamp(dates[warm]).date()
+        else:
+            # the day holding the start of the first new row's window
+            window_start = datetime.datetime.combine(cached_end + one_day, datetime.time()) - window_size * RANGE_PERIODS[grain][1]
+            warm_up = max(start_date, window_start.date())
+        tail = run_rolling_stats(conn, columns, window_size, warm_up, end_date, grain, window, statistics)
+        frames.append(rows_between(tail, low=np.datetime64(cached_end + one_day)))
+    return concat_frames(frames)
+
+
+def rolling_stats(conn, columns, window_size, start_date, end_date, grain='day', window='rows', statistics=('mean',)):
+    """Rolling statistics of the per-period totals of `columns`, returned as <column>_<statistic>.
+
+    window_size counts periods of the grain before the current one. A 'rows' window takes that many preceding rows.
+    A 'range' window takes the periods within that span of time, so missing periods shorten it; it is only
+    defined for the hour and day grains. Every statistic of every column shares one window, so DuckDB sorts and
+    frames the series once.
+
+    'ewma' is the exponentially weighted mean with a span of window_size + 1 periods, so window_size must be at
+    least 1. With 'rows' the weights decay per row. With 'range' they decay with the time elapsed, using the
+    half-life that gives the same weights when no period is missing.
     """
-    
-    df = conn.sql(query).fetchdf()
+    columns = [columns] if isinstance(columns, str) else list(columns)
+    if window_size < 0:
+        raise ValueError(f'window_size must not be negative, got {window_size}')
+    if 'ewma' in statistics and window_size < 1:
+        raise ValueError(f'ewma needs a window_size of at least 1, got {window_size}')
+    global _shared_rolling_result
+    if _shared_rolling_columns and set(columns) <= set(_shared_rolling_columns) and columns != _shared_rolling_columns:
+        key = (window_size, start_date, end_date, grain, window, tuple(statistics), _result_format)
+        if _shared_rolling_result is None or _shared_rolling_result[0] != key:
+            shared = rolling_stats(conn, _shared_rolling_columns, window_size, start_date, end_date, grain, window, statistics)
+            _shared_rolling_result = (key, shared)
+        return select_columns(_shared_rolling_result[1], rolling_stats_columns(columns, statistics))
+    # with a range cache set, moving the date range splices into the last result instead of recomputing it. Only day
+    # and hour buckets are whole at any range edge; a coarser grain's first and last periods depend on the range
+    dates = isinstance(start_date, datetime.date) and isinstance(end_date, datetime.date)
+    incremental = _range_cache is not None and grain in ('day', 'hour') and dates
+    df = None
+    if incremental:
+        key = (tuple(columns), window_size, grain, window, tuple(statistics), _result_format)
+        previous = _range_cache.get(key)
+        if previous is not None:
+            df = splice_rolling_stats(conn, columns, window_size, start_date, end_date, grain, window, statistics, previous)
+    if df is None:
+        df = run_rolling_stats(conn, columns, window_size, start_date, end_date, grain, window, statistics)
+    if incremental:
+        _range_cache.put(key, start_date, end_date, df)
+
+    if 'ewma' in statistics:
+        span = window_size + 1
+        for column in columns:
+            values = column_series(df, f'{column}_value')
+            if window == 'rows':
+                ewma = values.ewm(span=span).mean()
+            else:
+                # the weight of a period falls by 1 - alpha for each period elapsed, alpha = 2 / (span + 1)
+                halflife = math.log(2) / -math.log(1 - 2 / (span + 1)) * RANGE_PERIODS[grain][1]
+                ewma = values.ewm(halflife=halflife, times=date_values(df)).mean()
+            df = set_column(df, f'{column}_ewma', ewma.to_numpy())
+    if 'ewma' in statistics and 'value' not in statistics:
+        df = drop_columns(df, [f'{column}_value' for column in columns])
     return df
 
 
+def time_series_view_demand(conn, window_size, start_date, end_date, max_points=None):
+    df = rolling_stats(conn, ['demand'], window_size, start_date, end_date)
+    df = rename_columns(df, {'demand_mean': 'da'})
+    return downsample(df, 'date', 'da', max_points)
+
+
+def five_days_rolling_average_demand_by_year(conn,year, window_size):
+    df = rolling_stats(conn, ['demand'], window_size, datetime.date(year, 1, 1), datetime.date(year, 12, 31), statistics=('value', 'mean'))
+    return rename_columns(df, {'demand_value': 'd', 'demand_mean': 'da'})
+
+
 def yearly_avg_energy_source_contribution(conn, start_date, end_date):
+    if snapshot_covers(start_date, end_date):
+        return snapshot_result(_snapshot.yearly(ENERGY_MIX_COLUMNS, start_date, end_date))
     
+    source = GRAIN_TABLES[grain_source(conn, 'year', start_date, end_date)]
     query = f"""
     SELECT 
-        CAST(dt.year AS STRING) as year,
-        AVG(eof.coal) coal,
-        AVG(eof.nuclear) nuclear,
-        AVG(eof.ccgt) ccgt,
-        AVG(eof.wind) wind,
-        AVG(eof.pumped) pumped,
-        AVG(eof.hydro) hydro,
-        AVG(eof.biomass) biomass,
-        AVG(eof.oil) oil,
-        AVG(eof.solar) solar,
-        AVG(eof.ocgt) ocgt
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id
-    WHERE dt.timestamp::date BETWEEN '{start_date}::date' AND '{end_date}::date'
+        CAST(year AS STRING) as year,
+        SUM(coal_sum) / SUM(coal_count) coal,
+        SUM(nuclear_sum) / SUM(nuclear_count) nuclear,
+        SUM(ccgt_sum) / SUM(ccgt_count) ccgt,
+        SUM(wind_sum) / SUM(wind_count) wind,
+        SUM(pumped_sum) / SUM(pumped_count) pumped,
+        SUM(hydro_sum) / SUM(hydro_count) hydro,
+        SUM(biomass_sum) / SUM(biomass_count) biomass,
+        SUM(oil_sum) / SUM(oil_count) oil,
+        SUM(solar_sum) / SUM(solar_count) solar,
+        SUM(ocgt_sum) / SUM(ocgt_count) ocgt
+    FROM warehouse.{source}
+    WHERE {date_filter('$1', '$2')}
     GROUP BY 1;
     """
 
-    df = conn.sql(query).fetchdf()
+    df = run_query(conn, query, [start_date, end_date])
     return df
 
 
 def yearly_avg_energy_demand(conn, start_date, end_date):
+    if snapshot_covers(start_date, end_date):
+        return snapshot_result(_snapshot.yearly(['demand'], start_date, end_date))
     
+    source = GRAIN_TABLES[grain_source(conn, 'year', start_date, end_date)]
     query = f"""
     SELECT 
-        CAST(dt.year AS STRING) as year,
-        AVG(eof.demand) demand
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id
-    WHERE dt.timestamp::date BETWEEN '{start_date}::date' AND '{end_date}::date'
+        CAST(year AS STRING) as year,
+        SUM(demand_sum) / SUM(demand_count) demand
+    FROM warehouse.{source}
+    WHERE {date_filter('$1', '$2')}
     GROUP BY 1;
     """
 
-    df = conn.sql(query).fetchdf()
+    df = run_query(conn, query, [start_date, end_date])
     return df
 
 
-def daily_demand(conn,start_date, end_date):
-    
-    query = f"""
-    WITH base_tbl AS (
-    SELECT 
-        dt.timestamp::date as date,
-        SUM(eof.demand) as demand
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id 
-    WHERE dt.timestamp::date BETWEEN '{start_date}::date' AND '{end_date}::date'
-    GROUP BY 1
-    )
-    SELECT
-        date,
-        AVG(demand) OVER(ORDER BY date ROWS BETWEEN {27} PRECEDING AND CURRENT ROW) as demand
-    FROM base_tbl
-    ORDER BY 1
-    """
-    
-    df = conn.sql(query).fetchdf()
-    return df
+def daily_demand(conn,start_date, end_date, max_points=None, window_size=27):
+    df = rolling_stats(conn, ['demand'], window_size, start_date, end_date)
+    df = rename_columns(df, {'demand_mean': 'demand'})
+    return downsample(df, 'date', 'demand', max_points)
 
 
-def weekly_demand(conn,start_date, end_date):
-    
-    query = f"""
-    with base_tbl as (
-    SELECT 
-        CONCAT(YEAR(dt.timestamp::date),'-',WEEK(dt.timestamp::date)) as year_week,
-        SUM(eof.demand) as demand
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id 
-    WHERE dt.timestamp::date BETWEEN '{start_date}::date' AND '{end_date}::date'
-    GROUP BY 1
-    )
-    SELECT
-        year_week,
-        AVG(demand) OVER(ORDER BY year_week ROWS BETWEEN {3} PRECEDING AND CURRENT ROW) as demand
-    FROM base_tbl
-    ORDER BY 1
-    """
-    
-    df = conn.sql(query).fetchdf()
-    return df
+def weekly_demand(conn,start_date, end_date, window_size=3):
+    df = rolling_stats(conn, ['demand'], window_size, start_date, end_date, grain='week')
+    # ISO year and week, so the labels sort in time order
+    if isinstance(df, pd.DataFrame):
+        return pd.DataFrame({'year_week': df['date'].dt.strftime('%G-W%V'), 'demand': df['demand_mean']})
+    return pa.table({'year_week': pc.strftime(df['date'], format='%G-W%V'), 'demand': df['demand_mean']})
 
 
 def yearly_demand(conn,start_date, end_date):
+    if snapshot_covers(start_date, end_date):
+        return snapshot_result(_snapshot.yearly(['demand'], start_date, end_date, statistic='sum'))
     
+    source = GRAIN_TABLES[grain_source(conn, 'year', start_date, end_date)]
     query = f"""
-    with base_tbl as (
-    SELECT 
-        dt.timestamp::date as date,
-        SUM(eof.demand) as demand
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id 
-    WHERE dt.timestamp::date BETWEEN '{start_date}::date' AND '{end_date}::date'
-    GROUP BY 1
-    )
     SELECT
-        CONCAT(YEAR(date)) as year,
-        SUM(demand) demand
-    FROM base_tbl
+        CONCAT(year) as year,
+        ({period_total('demand')})::DOUBLE demand
+    FROM warehouse.{source}
+    WHERE {date_filter('$1', '$2')}
     GROUP BY 1
     ORDER BY 1
     """
     
-    df = conn.sql(query).fetchdf()
+    df = run_query(conn, query, [start_date, end_date])
     return df
 
 
-def energy_source_contribution(conn, window_size,start_date, end_date):
-    
-    query = f"""
-    with base_tbl AS (
-    SELECT 
-        dt.timestamp::date as date,
-        SUM(eof.coal) coal,
-        SUM(eof.nuclear) nuclear,
-        SUM(eof.ccgt) ccgt,
-        SUM(eof.wind) wind,
-        SUM(eof.pumped) pumped,
-        SUM(eof.hydro) hydro,
-        SUM(eof.biomass) biomass,
-        SUM(eof.oil) oil,
-        SUM(eof.solar) solar,
-        SUM(eof.ocgt) ocgt
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id
-    WHERE dt.timestamp::date BETWEEN '{start_date}::date' AND '{end_date}::date'
-    GROUP BY 1
-    )
+def energy_source_contribution(conn, window_size,start_date, end_date, max_points=None):
+    df = rolling_stats(conn, ENERGY_MIX_COLUMNS, window_size, start_date, end_date)
+    df = rename_columns(df, {f'{column}_mean': column for column in ENERGY_MIX_COLUMNS})
+    return downsample(df, 'date', ENERGY_MIX_COLUMNS, max_points)
+
+
+def energy_mix_query(grain, source, outputs):
+    # shares and carbon intensity are stored per period by setup_db.py, so a table of the requested grain is a lookup;
+    # coarser periods divide the summed generation and emissions again rather than averaging the finer ratios
+    if source == grain:
+        series = ',\n        '.join(f'{output} as {name}' for name, (output, _) in outputs.items())
+        group_by = ''
+    else:
+        series = ',\n        '.join(f'{rollup} as {name}' for name, (_, rollup) in outputs.items())
+        group_by = 'GROUP BY 1'
+    return f"""
     SELECT
-        date,
-        AVG(coal) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as coal,
-        AVG(nuclear) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as nuclear,
-        AVG(ccgt) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as ccgt,
-        AVG(wind) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as wind,
-        AVG(pumped) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as pumped,
-        AVG(hydro) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as hydro,
-        AVG(biomass) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as biomass,
-        AVG(oil) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as oil,
-        AVG(solar) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as solar,
-        AVG(ocgt) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as ocgt
-    FROM base_tbl    
+        {GRAIN_PERIODS[grain]} as date,
+        {series}
+    FROM warehouse.{GRAIN_TABLES[source]}
+    WHERE {date_filter('$1', '$2')}
+    {group_by}
+    ORDER BY date
     """
 
-    df = conn.sql(query).fetchdf()
-    return df
+
+def energy_mix_shares(conn, start_date, end_date, grain='month'):
+    # each source's fraction of the total generation per period
+    outputs = {column: (f'{column}_share', f'SUM({column}_sum) / NULLIF(SUM(generation_sum), 0)') for column in ENERGY_MIX_COLUMNS}
+    query = energy_mix_query(grain, grain_source(conn, grain, start_date, end_date), outputs)
+    return run_query(conn, query, [start_date, end_date])
+
+
+def carbon_intensity(conn, start_date, end_date, grain='day', max_points=None):
+    # estimated gCO2/kWh of the generation per period, with the lowest and highest reading inside it
+    outputs = {
+        'carbon_intensity': ('carbon_intensity', 'SUM(emissions_sum) / NULLIF(SUM(generation_sum), 0)'),
+        'carbon_intensity_min': ('carbon_intensity_min', 'MIN(carbon_intensity_min)'),
+        'carbon_intensity_max': ('carbon_intensity_max', 'MAX(carbon_intensity_max)'),
+    }
+    query = energy_mix_query(grain, grain_source(conn, grain, start_date, end_date), outputs)
+    df = run_query(conn, query, [start_date, end_date])
+    return downsample(df, 'date', ['carbon_intensity', 'carbon_intensity_min', 'carbon_intensity_max'], max_points)
 
 
 def nuclear_output(conn,year=2012):
+    if _snapshot is not None:
+        return snapshot_result(_snapshot.monthly('nuclear', year).rename(columns={'nuclear': 'total_nuclear'}))
     
+    source = GRAIN_TABLES[grain_source(conn, 'month', datetime.date(year, 1, 1), datetime.date(year, 12, 31))]
     query = f"""
     SELECT 
-        dt.month,
-        SUM(eof.nuclear) total_nuclear
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id
-    WHERE dt.year = {year}
+        MONTH(date) as month,
+        ({period_total('nuclear')})::DOUBLE total_nuclear
+    FROM warehouse.{source}
+    WHERE year = $1
     GROUP BY 1;
     """
 
-    df = conn.sql(query).fetchdf()
+    df = run_query(conn, query, [year])
     return df
 
 
-def french_interconnector(conn,window_size,start_date, end_date):
-    
-    query = f"""
-    WITH base_tbl AS (
-    SELECT 
-        dt.timestamp::date date,
-        SUM(eof.french_ict) french_ict
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id
-    WHERE dt.timestamp::date BETWEEN '{start_date}::date' AND '{end_date}::date'
-    GROUP BY 1
-    )
-    SELECT
-        date,
-        AVG(french_ict) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as french_ict,
-    FROM base_tbl
-    """
+def interconnector_flows(conn, columns, window_size, start, end, max_points=None):
     
-    df = conn.sql(query).fetchdf()
-    return df
+    unknown = set(columns) - set(INTERCONNECTOR_COLUMNS)
+    if unknown:
+        raise ValueError(f'Unknown interconnector columns: {sorted(unknown)}')
 
-    
-def dutch_interconnector(conn,window_size,start_date, end_date):
-    
-    query = f"""
-    WITH base_tbl AS (
-    SELECT 
-        dt.timestamp::date date,
-        SUM(eof.dutch_ict) dutch_ict
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id
-    WHERE dt.timestamp::date BETWEEN '{start_date}::date' AND '{end_date}::date'
-    GROUP BY 1
-    )
-    SELECT
-        date,
-        AVG(dutch_ict) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as dutch_ict,
-    FROM base_tbl
-    """
+    df = rolling_stats(conn, columns, window_size, start, end)
+    df = rename_columns(df, {f'{column}_mean': column for column in columns})
+    return downsample(df, 'date', columns, max_points)
 
-    df = conn.sql(query).fetchdf()
-    return df
 
+def french_interconnector(conn,window_size,start_date, end_date):
+    return interconnector_flows(conn, ['french_ict'], window_size, start_date, end_date)
 
-def irish_interconnector(conn,window_size,start_date, end_date):
-    
-    query = f"""
-    WITH base_tbl AS (
-    SELECT 
-        dt.timestamp::date date,
-        SUM(eof.irish_ict) irish_ict
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id
-    WHERE dt.timestamp::date BETWEEN '{start_date}::date' AND '{end_date}::date'
-    GROUP BY 1
-    )
-    SELECT
-        date,
-        AVG(irish_ict) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as irish_ict,
-    FROM base_tbl
-    """
 
-    df = conn.sql(query).fetchdf()
-    return df
+def dutch_interconnector(conn,window_size,start_date, end_date):
+    return interconnector_flows(conn, ['dutch_ict'], window_size, start_date, end_date)
 
 
-def ew_interconnector(conn,window_size,start_date, end_date):
-    
-    query = f"""
-    WITH base_tbl AS (
-    SELECT 
-        dt.timestamp::date date,
-        SUM(eof.ew_ict) ew_ict
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id
-    WHERE dt.timestamp::date BETWEEN '{start_date}::date' AND '{end_date}::date'
-    GROUP BY 1
-    )
-    SELECT
-        date,
-        AVG(ew_ict) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as ew_ict,
-    FROM base_tbl
-    """
+def irish_interconnector(conn,window_size,start_date, end_date):
+    return interconnector_flows(conn, ['irish_ict'], window_size, start_date, end_date)
 
-    df = conn.sql(query).fetchdf()
-    return df
 
+def ew_interconnector(conn,window_size,start_date, end_date):
+    return interconnector_flows(conn, ['ew_ict'], window_size, start_date, end_date)
 
-def nemo_interconnector(conn,window_size,start_date, end_date):
-    
-    query = f"""
-    WITH base_tbl AS (
-    SELECT 
-        dt.timestamp::date date,
-        SUM(eof.nemo) nemo
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id
-    WHERE dt.timestamp::date BETWEEN '{start_date}::date' AND '{end_date}::date'
-    GROUP BY 1
-    )
-    SELECT
-        date,
-        AVG(nemo) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as nemo,
-    FROM base_tbl
-    """
 
-    df = conn.sql(query).fetchdf()
-    return df
+def nemo_interconnector(conn,window_size,start_date, end_date):
+    return interconnector_flows(conn, ['nemo'], window_size, start_date, end_date)
 
 
 def french_interconnector_two(conn,window_size,start_date, end_date):
-    
-    query = f"""
-    WITH base_tbl AS (
-    SELECT 
-        dt.timestamp::date date,
-        SUM(eof.french_ict_2) french_ict_2
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id
-    WHERE dt.timestamp::date BETWEEN '{start_date}::date' AND '{end_date}::date'
-    GROUP BY 1
-    )
-    SELECT
-        date,
-        AVG(french_ict_2) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as french_ict_2,
-    FROM base_tbl
-    """
-
-    df = conn.sql(query).fetchdf()
-    return df
+    return interconnector_flows(conn, ['french_ict_2'], window_size, start_date, end_date)
 
 
 def french_interconnector_intelec(conn,window_size,start_date, end_date):
-    
-    query = f"""
-    WITH base_tbl AS (
-    SELECT 
-        dt.timestamp::date date,
-        SUM(eof.french_ict_intelec) french_ict_intelec
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id
-    WHERE dt.timestamp::date BETWEEN '{start_date}::date' AND '{end_date}::date'
-    GROUP BY 1
-    )
-    SELECT
-        date,
-        AVG(french_ict_intelec) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as french_ict_intelec,
-    FROM base_tbl
-    """
-
-    df = conn.sql(query).fetchdf()
-    return df
+    return interconnector_flows(conn, ['french_ict_intelec'], window_size, start_date, end_date)
 
 
 def norway_interconnector(conn,window_size,start_date, end_date):
-    
-    query = f"""
-    WITH base_tbl AS (
-    SELECT 
-        dt.timestamp::date date,
-        SUM(eof.norway_ict) norway_ict
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id
-    WHERE dt.timestamp::date BETWEEN '{start_date}::date' AND '{end_date}::date'
-    GROUP BY 1
-    )
-    SELECT
-        date,
-        AVG(norway_ict) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as norway_ict,
-    FROM base_tbl
-    """
-
-    df = conn.sql(query).fetchdf()
-    return df
+    return interconnector_flows(conn, ['norway_ict'], window_size, start_date, end_date)
 
 
 def viking_interconnector(conn,window_size,start_date, end_date):
-    
-    query = f"""
-    WITH base_tbl AS (
-    SELECT 
-        dt.timestamp::date date,
-        SUM(eof.vkl_ict) vkl_ict
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id
-    WHERE dt.timestamp::date BETWEEN '{start_date}::date' AND '{end_date}::date'
-    GROUP BY 1
-    )
-    SELECT
-        date,
-        AVG(vkl_ict) OVER(ORDER BY date ROWS BETWEEN {window_size} PRECEDING AND CURRENT ROW) as vkl_ict,
-    FROM base_tbl
-    """
-
-    df = conn.sql(query).fetchdf()
-    return df
+    return interconnector_flows(conn, ['vkl_ict'], window_size, start_date, end_date)
 
 
 def daily_min_max_demand(conn,start_date, end_date):
     
     query = f"""
     SELECT 
-        dt.timestamp::date as date,
-        MAX(eof.demand) as max_demand,
-        MIN(eof.demand) as min_demand
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id 
-    WHERE dt.timestamp::date BETWEEN '{start_date}::date' AND '{end_date}::date'
-    GROUP BY 1
+        date,
+        demand_max as max_demand,
+        demand_min as min_demand
+    FROM warehouse.agg_daily
+    WHERE {date_filter('$1', '$2')}
     """
     
-    df = conn.sql(query).fetchdf()
+    df = run_query(conn, query, [start_date, end_date])
     return df
 
 
 def weekly_min_max_demand(conn,start_date, end_date):
     
+    source = GRAIN_TABLES[grain_source(conn, 'week', start_date, end_date)]
     query = f"""
-    with base_tbl as (
-    SELECT 
-        dt.timestamp::date as date,
-        MAX(eof.demand) as max_demand,
-        MIN(eof.demand) as min_demand
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id 
-    WHERE dt.timestamp::date BETWEEN '{start_date}::date' AND '{end_date}::date'
-    GROUP BY 1
-    )
     SELECT
-        CONCAT(YEAR(date),'-',WEEK(date)) as year_week,
-        SUM(max_demand) as max_demand,
-        SUM(min_demand) as min_demand
-    FROM base_tbl
+        strftime(date_trunc('week', date), '%G-W%V') as year_week,
+        MAX(demand_max) as max_demand,
+        MIN(demand_min) as min_demand
+    FROM warehouse.{source}
+    WHERE {date_filter('$1', '$2')}
     GROUP BY 1
     ORDER BY 1
     """
     
-    df = conn.sql(query).fetchdf()
+    df = run_query(conn, query, [start_date, end_date])
     return df
 
 
 def yearly_min_max_demand(conn,start_date, end_date):
     
+    source = GRAIN_TABLES[grain_source(conn, 'year', start_date, end_date)]
     query = f"""
-    with base_tbl as (
-    SELECT 
-        dt.timestamp::date as date,
-        MAX(eof.demand) as max_demand,
-        MIN(eof.demand) as min_demand
-    FROM warehouse.fct_gridwatch g
-    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
-    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id 
-    WHERE dt.timestamp::date BETWEEN '{start_date}::date' AND '{end_date}::date'
-    GROUP BY 1
-    )
     SELECT
-        CONCAT(YEAR(date)) as year,
-        SUM(max_demand) as max_demand,
-        SUM(min_demand) as min_demand
-    FROM base_tbl
+        CONCAT(year) as year,
+        MAX(demand_max) as max_demand,
+        MIN(demand_min) as min_demand
+    FROM warehouse.{source}
+    WHERE {date_filter('$1', '$2')}
     GROUP BY 1
     ORDER BY 1
     """
     
-    df = conn.sql(query).fetchdf()
+    df = run_query(conn, query, [start_date, end_date])
     return df
 
+
+def demand_turning_points(conn, start_date, end_date, window_size=27, prominence_ratio=0.1):
+    # peaks and troughs of the smoothed daily demand, see peaks.detect_peaks
+    df = daily_demand(conn, start_date, end_date, window_size=window_size)
+    return detect_peaks(df, 'date', 'demand', prominence_ratio=prominence_ratio)
+
+
+# every query function above, grouped by the parameters it takes; used by benchmark.py and report.py
+WINDOWED_QUERIES = {
+    'time_series_view_demand': time_series_view_demand,
+    'energy_source_contribution': energy_source_contribution,
+    'interconnector_flows': lambda conn, window_size, start_date, end_date, max_points=None, columns=INTERCONNECTOR_COLUMNS: interconnector_flows(
+        conn, columns, window_size, start_date, end_date, max_points),
+    'french_interconnector': french_interconnector,
+    'dutch_interconnector': dutch_interconnector,
+    'irish_interconnector': irish_interconnector,
+    'ew_interconnector': ew_interconnector,
+    'nemo_interconnector': nemo_interconnector,
+    'french_interconnector_two': french_interconnector_two,
+    'french_interconnector_intelec': french_interconnector_intelec,
+    'norway_interconnector': norway_interconnector,
+    'viking_interconnector': viking_interconnector,
+}
+RANGE_QUERIES = {
+    'yearly_avg_energy_source_contribution': yearly_avg_energy_source_contribution,
+    'yearly_avg_energy_demand': yearly_avg_energy_demand,
+    'daily_demand': daily_demand,
+    'weekly_demand': weekly_demand,
+    'yearly_demand': yearly_demand,
+    'daily_min_max_demand': daily_min_max_demand,
+    'weekly_min_max_demand': weekly_min_max_demand,
+    'yearly_min_max_demand': yearly_min_max_demand,
+    'energy_mix_shares': energy_mix_shares,
+    'carbon_intensity': carbon_intensity,
+}
+YEAR_QUERIES = {
+    'five_days_rolling_average_demand_by_year': lambda conn, year, window_size: five_days_rolling_average_demand_by_year(conn, year, window_size),
+    'nuclear_output': lambda conn, year, window_size: nuclear_output(conn, year),
+}
+
 if __name__ == '__main__':
     pass
-
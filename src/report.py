@@ -0,0 +1,213 @@
+import argparse
+import concurrent.futures
+import datetime
+import inspect
+import json
+import multiprocessing
+import os
+import time
+
+import duckdb as ddb
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+import queries
+
+DB_PATH = 'gridwatch.db'
+OUTPUT_DIR = 'reports'
+QUERIES = {**queries.WINDOWED_QUERIES, **queries.RANGE_QUERIES, **queries.YEAR_QUERIES}
+# everything the rolling queries chart; one scan per period and window size computes them all
+SHARED_COLUMNS = ['demand'] + queries.ENERGY_MIX_COLUMNS + queries.INTERCONNECTOR_COLUMNS
+
+# the read-only connection of a worker process, opened by start_worker
+_conn = None
+
+
+def parse_range(value):
+    start, _, end = value.partition(':')
+    start, end = datetime.date.fromisoformat(start), datetime.date.fromisoformat(end)
+    if start > end:
+        raise ValueError(f'Range ends before it starts: {value}')
+    return start, end
+
+
+def report_ranges(first, last, ranges=(), years=(), trailing_days=()):
+    # explicit ranges, calendar years and the last N days of the data, all clipped to [first, last]; the full
+    # history when none is asked for
+    found = [parse_range(value) for value in ranges]
+    found += [(datetime.date(year, 1, 1), datetime.date(year, 12, 31)) for year in years]
+    found += [(last - datetime.timedelta(days=days - 1), last) for days in trailing_days]
+    if not found:
+        found = [(first, last)]
+    clipped = {(max(start, first), min(end, last)) for start, end in found}
+    return sorted((start, end) for start, end in clipped if start <= end)
+
+
+def plan_jobs(query_names, ranges, years, window_sizes):
+    # one job per query call; the year queries run over the requested years, or every year of the ranges
+    if not years:
+        years = sorted({year for start, end in ranges for year in range(start.year, end.year + 1)})
+    jobs = []
+    for name in query_names:
+        if name in queries.WINDOWED_QUERIES:
+            jobs += [{'query': name, 'start': start, 'end': end, 'window': window_size}
+                     for window_size in window_sizes for start, end in ranges]
+        elif name in queries.RANGE_QUERIES:
+            jobs += [{'query': name, 'start': start, 'end': end, 'window': None} for start, end in ranges]
+        elif 'window_size' in inspect.signature(getattr(queries, name)).parameters:
+            jobs += [{'query': name, 'year': year, 'window': window_size} for window_size in window_sizes for year in years]
+        else:
+            # a year query without a window, e.g. nuclear_output, is the same for every window size
+            jobs += [{'query': name, 'year': year, 'window': None} for year in years]
+    return jobs
+
+
+def batch_jobs(jobs):
+    # the jobs over one period and window size run together, so the rolling queries among them share one scan
+    batches = {}
+    for job in jobs:
+        batches.setdefault((job.get('start'), job.get('end'), job.get('year'), job['window']), []).append(job)
+    return list(batches.values())
+
+
+def job_path(job, output_format):
+    period = str(job['year']) if 'year' in job else f"{job['start']}_{job['end']}"
+    window = f"_w{job['window']}" if job['window'] is not None else ''
+    return os.path.join(job['query'], f'{period}{window}.{output_format}')
+
+
+def run_job(conn, job):
+    query = QUERIES[job['query']]
+    if job['query'] in queries.WINDOWED_QUERIES:
+        return query(conn, window_size=job['window'], start_date=job['start'], end_date=job['end'])
+    if job['query'] in queries.RANGE_QUERIES:
+        return query(conn, start_date=job['start'], end_date=job['end'])
+    return query(conn, year=job['year'], window_size=job['window'])
+
+
+def write_result(result, path, output_format, compression):
+    table = result if isinstance(result, pa.Table) else pa.Table.from_pandas(result, preserve_index=False)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if output_format == 'parquet':
+        pq.write_table(table, path, compression=compression)
+    else:
+        pa_csv.write_csv(table, path)
+    return table.num_rows
+
+
+def start_worker(db_path):
+    # results stay Arrow tables all the way to the file
+    global _conn
+    _conn = ddb.connect(db_path, read_only=True)
+    queries.use_result_format('arrow')
+    queries.share_rolling_scans(SHARED_COLUMNS)
+
+
+def run_batch(jobs, output_dir, output_format, compression):
+    entries = []
+    for job in jobs:
+        started = time.perf_counter()
+        result = run_job(_conn, job)
+        path = os.path.join(output_dir, job_path(job, output_format))
+        rows = write_result(result, path, output_format, compression)
+        entries.append({
+            **{key: value.isoformat() if isinstance(value, datetime.date) else value for key, value in job.items()},
+            'path': os.path.relpath(path, output_dir),
+            'rows': rows,
+            'seconds': time.perf_counter() - started,
+            'pid': os.getpid(),
+        })
+    return entries
+
+
+def run_report(db_path, query_names, ranges=(), years=(), trailing_days=(), window_sizes=(27,), output_dir=OUTPUT_DIR,
+               output_format='parquet', compression='zstd', processes=1):
+    with ddb.connect(db_path, read_only=True) as conn:
+        first, last = conn.sql('SELECT MIN(date), MAX(date) FROM warehouse.agg_daily').fetchone()
+    report_years = [year for year in years if first.year <= year <= last.year]
+    jobs = plan_jobs(query_names, report_ranges(first, last, ranges, report_years, trailing_days), report_years, window_sizes)
+    # every result gets a file of its own; the period and window size are in the name
+    paths = [job_path(job, output_format) for job in jobs]
+    duplicates = sorted({path for path in paths if paths.count(path) > 1})
+    if duplicates:
+        raise ValueError(f'Jobs would overwrite each other: {duplicates}')
+    batches = batch_jobs(jobs)
+
+    started = time.perf_counter()
+    entries = []
+    if processes == 1:
+        start_worker(db_path)
+        for batch in batches:
+            entries += run_batch(batch, output_dir, output_format, compression)
+    else:
+        # spawned rather than forked, so no worker inherits a DuckDB instance from the parent
+        context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(processes, mp_context=context, initializer=start_worker, initargs=(db_path,)) as pool:
+            futures = [pool.submit(run_batch, batch, output_dir, output_format, compression) for batch in batches]
+            for future in futures:
+                entries += future.result()
+
+    manifest = {
+        'generated_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'db': os.path.abspath(db_path),
+        'format': output_format,
+        'processes': processes,
+        'seconds': time.perf_counter() - started,
+        'results': entries,
+    }
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def parse_args(argv=None):
+    # options can also come from a JSON file whose keys are the option names, e.g. {"queries": [...], "years": [2023]};
+    # anything given on the command line wins
+    pre_parser = argparse.ArgumentParser(add_help=False)
+    pre_parser.add_argument('--config')
+    config_args, _ = pre_parser.parse_known_args(argv)
+
+    parser = argparse.ArgumentParser(description='Run queries.py analyses over many date ranges and write the results to files',
+                                     parents=[pre_parser])
+    parser.add_argument('--db', default=DB_PATH)
+    parser.add_argument('--queries', nargs='+', choices=sorted(QUERIES), default=sorted(QUERIES), metavar='QUERY',
+                        help='query functions to run, all of them by default')
+    parser.add_argument('--ranges', nargs='+', default=[], metavar='START:END', help='date ranges, e.g. 2023-01-01:2023-06-30')
+    parser.add_argument('--years', nargs='+', type=int, default=[], help='calendar years to report on')
+    parser.add_argument('--trailing-days', nargs='+', type=int, default=[], help='ranges ending on the last day of data')
+    parser.add_argument('--window-sizes', nargs='+', type=int, default=[27], help='window sizes for the rolling queries')
+    parser.add_argument('--output-dir', default=OUTPUT_DIR)
+    parser.add_argument('--format', choices=['parquet', 'csv'], default='parquet')
+    parser.add_argument('--compression', choices=['zstd', 'snappy', 'gzip'], default='zstd', help='parquet compression codec')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    if config_args.config:
+        with open(config_args.config) as f:
+            config = json.load(f)
+        unknown = set(config) - {action.dest for action in parser._actions}
+        if unknown:
+            parser.error(f'Unknown options in {config_args.config}: {sorted(unknown)}')
+        parser.set_defaults(**config)
+    args = parser.parse_args(argv)
+    unknown = set(args.queries) - set(QUERIES)
+    if unknown:
+        parser.error(f'Unknown queries: {sorted(unknown)}')
+    try:
+        [parse_range(value) for value in args.ranges]
+    except ValueError as error:
+        parser.error(str(error))
+    return args
+
+
+def main():
+    args = parse_args()
+    manifest = run_report(args.db, args.queries, args.ranges, args.years, args.trailing_days, args.window_sizes,
+                          args.output_dir, args.format, args.compression, args.processes)
+    rows = sum(entry['rows'] for entry in manifest['results'])
+    print(f"{len(manifest['results'])} results, {rows} rows written to {args.output_dir} "
+          f"in {manifest['seconds']:.2f}s on {args.processes} processes")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,69 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import resource
+import shutil
+
 import duckdb as ddb
+import numpy as np
 import pandas as pd
 
+from snapshot import SOURCE_FILE, warehouse_version
+
+MEASURE_COLUMNS = ['demand', 'frequency', 'coal', 'nuclear', 'ccgt', 'wind', 'pumped', 'hydro', 'biomass', 'oil', 'solar', 'ocgt',
+       'french_ict', 'dutch_ict', 'irish_ict', 'ew_ict', 'nemo', 'other',
+       'north_south', 'scotland_england', 'french_ict_2', 'french_ict_intelec', 'norway_ict',
+       'vkl_ict']
+
+RENAMED_COLUMNS = {
+    'id': 'energy_id',
+    'ifa2' : 'french_ict_2',
+    'intelec_ict' : 'french_ict_intelec',
+    'nsl' : 'norway_ict', 
+}
+
+DATA_DIR = 'data'
+CSV_PATH = f'{DATA_DIR}/gridwatch_110514_240914.csv'
+PARQUET_DATASET_DIR = f'{DATA_DIR}/parquet'
+SNAPSHOT_DIR = f'{DATA_DIR}/snapshot'
+DB_PATH = 'gridwatch.db'
+# grain tables rolled up from agg_daily
+ROLLUP_TABLES = {'week': 'agg_weekly', 'month': 'agg_monthly', 'year': 'agg_yearly'}
+
+# declared column types of the star schema, applied by every build path: unsigned surrogate keys, calendar parts
+# at their natural width and each measure at the narrowest type that holds it. Interconnector flows and `other`
+# stay within +/-32767 MW, demand, generation and the boundary flows need 32 bits, frequency is the only fraction.
+# A reading that is not a whole number in its type's range fails the build instead of being rounded or wrapped
+SMALL_MEASURES = ['french_ict', 'dutch_ict', 'irish_ict', 'ew_ict', 'nemo', 'other', 'french_ict_2', 'french_ict_intelec',
+                  'norway_ict', 'vkl_ict']
+MEASURE_TYPES = {column: 'FLOAT' if column == 'frequency' else 'SMALLINT' if column in SMALL_MEASURES else 'INTEGER'
+                 for column in MEASURE_COLUMNS}
+INTEGER_RANGES = {'SMALLINT': (-2**15, 2**15 - 1), 'INTEGER': (-2**31, 2**31 - 1)}
+# readings are normalized onto a regular spine of 5-minute slots before they are aggregated; runs of up to an hour of
+# missing slots are interpolated, longer outages stay missing and are listed in warehouse.gap_index
+INTERVAL_MINUTES = 5
+MAX_INTERPOLATED_SLOTS = 12
+# the sources whose output adds up to the generation the mix shares and carbon intensity are taken over;
+# interconnector imports and pumped storage pumping are left out
+GENERATION_COLUMNS = ['coal', 'nuclear', 'ccgt', 'wind', 'pumped', 'hydro', 'biomass', 'oil', 'solar', 'ocgt']
+# gCO2 per kWh generated, the factors of the GB Carbon Intensity API methodology; override them with
+# --emission-factors. The factors a warehouse was built with are kept in warehouse.emission_factors
+EMISSION_FACTORS = {'coal': 937, 'nuclear': 0, 'ccgt': 394, 'wind': 0, 'pumped': 0, 'hydro': 0, 'biomass': 120, 'oil': 935,
+                    'solar': 0, 'ocgt': 651}
+# per-slot measures derived from the readings and aggregated like them: total generation in MW and the emission
+# rate in kgCO2/h (MW times gCO2/kWh)
+DERIVED_MEASURES = ['generation', 'emissions']
+TABLE_SCHEMAS = {
+    'fct_gridwatch': {'fact_id': 'UINTEGER', 'datetime_id': 'UINTEGER', 'energy_id': 'UINTEGER'},
+    'dim_datetime': {
+        'datetime_id': 'UINTEGER', 'timestamp': 'TIMESTAMP', 'year': 'USMALLINT', 'month': 'UTINYINT', 'day': 'UTINYINT',
+        'hour': 'UTINYINT', 'day_of_week': 'UTINYINT', 'week': 'UTINYINT',
+    },
+    'dim_energy_output_and_flow': {'energy_id': 'UINTEGER', **MEASURE_TYPES},
+}
+
 def basic_data_cleaning(df):
     df.columns = [column.lower().strip() for column in df.columns]
     if 'timestamp' in df.columns: df['timestamp'] = pd.to_datetime(df.timestamp)
@@ -34,12 +97,7 @@ def create_dim_energy_output_flow_df(df):
        'vkl_ict']]\
         .drop_duplicates()
         
-    dim_energy_output_and_flow = dim_energy_output_and_flow.rename(columns={
-        'id': 'energy_id',
-        'ifa2' : 'french_ict_2',
-        'intelec_ict' : 'french_ict_intelec',
-        'nsl' : 'norway_ict', 
-    })
+    dim_energy_output_and_flow = dim_energy_output_and_flow.rename(columns=RENAMED_COLUMNS)
     
     
 
@@ -61,56 +119,660 @@ def create_fct_gridwatch_df(df, dim_energy_output_and_flow, dim_datetime):
     return fct_gridwatch
 
 
-def export_all_tbl(dim_datetime, dim_energy_output_and_flow, fct_gridwatch):
-    dim_datetime.to_parquet('../data/dim_datetime.gzip',compression='gzip')
-    dim_energy_output_and_flow.to_parquet('../data/dim_energy_output_and_flow.gzip',compression='gzip')
-    fct_gridwatch.to_parquet('../data/fct_gridwatch.gzip',compression='gzip')
+def export_all_tbl(dim_datetime, dim_energy_output_and_flow, fct_gridwatch, compression='zstd', row_group_size=None, sort=True):
+    if sort:
+        dim_datetime = dim_datetime.sort_values('timestamp')
+        dim_energy_output_and_flow = dim_energy_output_and_flow.sort_values('energy_id')
+        fct_gridwatch = fct_gridwatch.sort_values('fact_id')
+
+    dim_datetime.to_parquet(f'{DATA_DIR}/dim_datetime.parquet',compression=compression,row_group_size=row_group_size,index=False)
+    dim_energy_output_and_flow.to_parquet(f'{DATA_DIR}/dim_energy_output_and_flow.parquet',compression=compression,row_group_size=row_group_size,index=False)
+    fct_gridwatch.to_parquet(f'{DATA_DIR}/fct_gridwatch.parquet',compression=compression,row_group_size=row_group_size,index=False)
 
 
-def run_etl_pipeline():
-    df = pd.read_csv('data/gridwatch_110514_240914.csv')
+def run_etl_pipeline(csv_path=CSV_PATH, compression='zstd', row_group_size=None):
+    df = pd.read_csv(csv_path)
     df = basic_data_cleaning(df)
     dim_datetime = create_dim_datetime_df(df)
     dim_energy_output_and_flow = create_dim_energy_output_flow_df(df)
     fct_gridwatch = create_fct_gridwatch_df(df, dim_energy_output_and_flow=dim_energy_output_and_flow, dim_datetime=dim_datetime )
-    export_all_tbl(dim_datetime=dim_datetime, dim_energy_output_and_flow=dim_energy_output_and_flow, fct_gridwatch=fct_gridwatch)
+    export_all_tbl(dim_datetime=dim_datetime, dim_energy_output_and_flow=dim_energy_output_and_flow, fct_gridwatch=fct_gridwatch,
+                   compression=compression, row_group_size=row_group_size)
 
 
 def create_schema(conn):
     create_schema_query ="""
-    CREATE SCHEMA warehouse;
+    CREATE SCHEMA IF NOT EXISTS warehouse;
     """
     conn.execute(create_schema_query)
 
 
 def create_tables_in_schema(conn):
-    
-    create_fct_table_query ="""
-    CREATE OR REPLACE TABLE warehouse.fct_gridwatch AS
-    SELECT * FROM read_parquet('data/fct_gridwatch.gzip');
+    # the parquet files carry whatever pandas inferred; inserting into the declared tables narrows them
+    create_empty_tables_in_schema(conn)
+    check_measures(conn, f"read_parquet('{DATA_DIR}/dim_energy_output_and_flow.parquet')")
+    for table_name in TABLE_SCHEMAS:
+        conn.execute(f"INSERT INTO warehouse.{table_name} BY NAME SELECT * FROM read_parquet('{DATA_DIR}/{table_name}.parquet')")
+
+
+def create_empty_tables_in_schema(conn):
+    for table_name, schema in TABLE_SCHEMAS.items():
+        columns = ',\n        '.join(f'{column} {column_type}' for column, column_type in schema.items())
+        conn.execute(f"""
+        CREATE OR REPLACE TABLE warehouse.{table_name} (
+            {columns}
+        );
+        """)
+
+
+def check_measures(conn, relation):
+    # DuckDB rounds a fraction cast to an integer type and reports an overflow without naming the column, so the
+    # readings are checked against the declared types before they are inserted
+    narrowed = [column for column in MEASURE_COLUMNS if MEASURE_TYPES[column] in INTEGER_RANGES]
+    checks = ', '.join(
+        f'ANY_VALUE({column}) FILTER (WHERE {column} <> ROUND({column}) OR {column} NOT BETWEEN {low} AND {high})'
+        for column in narrowed for low, high in [INTEGER_RANGES[MEASURE_TYPES[column]]]
+    )
+    values = conn.execute(f'SELECT {checks} FROM {relation}').fetchone()
+    bad = [f'{column} ({MEASURE_TYPES[column]}, e.g. {value})' for column, value in zip(narrowed, values) if value is not None]
+    if bad:
+        raise ValueError(f"readings that are not whole numbers in the range of their declared type: {', '.join(bad)}; "
+                         'widen the column in MEASURE_TYPES, to FLOAT if it has fractions')
+
+
+def load_chunk(conn, df):
+    # the dimensions are de-duplicated against what earlier chunks already loaded, and the fact rows
+    # are keyed in DuckDB so a timestamp first seen in an earlier chunk keeps its datetime_id
+    chunk_dim_datetime = create_dim_datetime_df(df)
+    chunk_dim_energy_output_and_flow = create_dim_energy_output_flow_df(df)
+    chunk_fct_gridwatch = df.reset_index().rename(columns={'index':'fact_id', 'id':'energy_id'}).loc[:,['fact_id','energy_id','timestamp']]
+
+    conn.register('chunk_dim_datetime', chunk_dim_datetime)
+    conn.register('chunk_dim_energy_output_and_flow', chunk_dim_energy_output_and_flow)
+    conn.register('chunk_fct_gridwatch', chunk_fct_gridwatch)
+    check_measures(conn, 'chunk_dim_energy_output_and_flow')
+
+    # the lookups into what is already loaded only read the chunk's own span of timestamps and ids; extracts are
+    # ordered by time, so the zone maps skip the rest and a chunk costs the same however much came before it
+    timestamps = [chunk_dim_datetime.timestamp.min(), chunk_dim_datetime.timestamp.max()]
+    energy_ids = [int(chunk_dim_energy_output_and_flow.energy_id.min()), int(chunk_dim_energy_output_and_flow.energy_id.max())]
+
+    conn.execute("""
+    INSERT INTO warehouse.dim_datetime BY NAME
+    SELECT c.* FROM chunk_dim_datetime c
+    WHERE NOT EXISTS (SELECT 1 FROM warehouse.dim_datetime dt WHERE dt.timestamp = c.timestamp AND dt.timestamp BETWEEN $1 AND $2);
+    """, timestamps)
+
+    conn.execute("""
+    INSERT INTO warehouse.dim_energy_output_and_flow BY NAME
+    SELECT c.* FROM chunk_dim_energy_output_and_flow c
+    WHERE NOT EXISTS (SELECT 1 FROM warehouse.dim_energy_output_and_flow eof WHERE eof.energy_id = c.energy_id AND eof.energy_id BETWEEN $1 AND $2);
+    """, energy_ids)
+
+    conn.execute("""
+    INSERT INTO warehouse.fct_gridwatch
+    SELECT c.fact_id, dt.datetime_id, c.energy_id
+    FROM chunk_fct_gridwatch c
+    JOIN warehouse.dim_datetime dt ON dt.timestamp = c.timestamp
+    WHERE dt.timestamp BETWEEN $1 AND $2;
+    """, timestamps)
+
+    for view_name in ['chunk_dim_datetime', 'chunk_dim_energy_output_and_flow', 'chunk_fct_gridwatch']:
+        conn.unregister(view_name)
+
+
+def run_streaming_etl_pipeline(conn, csv_path=CSV_PATH, chunksize=100_000):
+    # reads the CSV in bounded chunks and writes straight into DuckDB, so pandas never holds more than
+    # one chunk and the intermediate parquet files are skipped
+    create_schema(conn)
+    create_empty_tables_in_schema(conn)
+    for df in pd.read_csv(csv_path, chunksize=chunksize):
+        df = basic_data_cleaning(df)
+        load_chunk(conn, df)
+
+
+def run_sql_etl_pipeline(conn, csv_path=CSV_PATH):
+    # the same star schema as the pandas path, built by DuckDB straight from the CSV on all cores;
+    # rowid of the staging table is the CSV row number that the pandas path uses as its index
+    raw_columns = conn.execute('DESCRIBE SELECT * FROM read_csv(?, header = true)', [csv_path]).fetchall()
+    columns = ', '.join(f'"{column[0]}" AS {column[0].lower().strip()}' for column in raw_columns)
+    raw_names = {renamed: raw for raw, renamed in RENAMED_COLUMNS.items()}
+    renamed_measures = ', '.join(f'{raw_names.get(column, column)} as {column}' for column in MEASURE_COLUMNS)
+
+    create_schema(conn)
+    create_empty_tables_in_schema(conn)
+
+    conn.execute(f"""
+    CREATE OR REPLACE TEMP TABLE gridwatch_raw AS
+    SELECT {columns} FROM read_csv(?, header = true);
+    """, [csv_path])
+    check_measures(conn, f'(SELECT {renamed_measures} FROM gridwatch_raw)')
+
+    conn.execute("""
+    INSERT INTO warehouse.dim_datetime BY NAME
+    SELECT
+        MIN(rowid) as datetime_id,
+        timestamp,
+        YEAR(timestamp) as year,
+        MONTH(timestamp) as month,
+        DAY(timestamp) as day,
+        HOUR(timestamp) as hour,
+        ISODOW(timestamp) - 1 as day_of_week,
+        WEEK(timestamp) as week
+    FROM gridwatch_raw
+    GROUP BY timestamp
+    ORDER BY datetime_id;
+    """)
+
+    conn.execute(f"""
+    INSERT INTO warehouse.dim_energy_output_and_flow BY NAME
+    SELECT DISTINCT id as energy_id, {renamed_measures}
+    FROM gridwatch_raw;
+    """)
+
+    conn.execute("""
+    INSERT INTO warehouse.fct_gridwatch BY NAME
+    SELECT r.rowid as fact_id, dt.datetime_id, eof.energy_id
+    FROM gridwatch_raw r
+    JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = r.id
+    JOIN warehouse.dim_datetime dt ON dt.timestamp = r.timestamp
+    ORDER BY fact_id;
+    """)
+
+    conn.execute('DROP TABLE gridwatch_raw')
+
+
+def table_exists(conn, table_name):
+    query = """
+    SELECT COUNT(*) FROM information_schema.tables
+    WHERE table_schema = 'warehouse' AND table_name = ?
+    """
+    return conn.execute(query, [table_name]).fetchone()[0] > 0
+
+
+def run_incremental_load(conn, csv_path, chunksize=100_000):
+    # appends only the rows newer than what the warehouse already holds; new surrogate keys continue
+    # after the existing ones so fact_id/datetime_id stay unique and the fact rows keep joining
+    high_water_mark, max_fact_id, max_datetime_id = conn.sql("""
+    SELECT MAX(dt.timestamp), (SELECT MAX(fact_id) FROM warehouse.fct_gridwatch), MAX(dt.datetime_id)
+    FROM warehouse.dim_datetime dt
+    """).fetchone()
+    max_energy_id = conn.sql('SELECT MAX(energy_id) FROM warehouse.dim_energy_output_and_flow').fetchone()[0]
+    if high_water_mark is None:
+        raise ValueError('warehouse.dim_datetime is empty, run a full build before an incremental load')
+
+    next_id = max(max_fact_id, max_datetime_id) + 1
+    appended = 0
+    for df in pd.read_csv(csv_path, chunksize=chunksize):
+        df = basic_data_cleaning(df)
+        df = df[df.timestamp > high_water_mark]
+        if df.empty:
+            continue
+
+        df.index = pd.RangeIndex(next_id, next_id + len(df))
+        next_id += len(df)
+        # Gridwatch ids are global, so a newer extract normally continues them; renumber if it doesn't
+        if df.id.min() <= max_energy_id:
+            df = df.assign(id=pd.RangeIndex(max_energy_id + 1, max_energy_id + 1 + len(df)))
+        max_energy_id = int(df.id.max())
+
+        load_chunk(conn, df)
+        appended += len(df)
+
+    if appended:
+        refresh_derived_tables(conn, high_water_mark)
+    return high_water_mark, appended
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def year_batches(conn, table_name, start=None):
+    # [start, end) timestamps of every calendar year `table_name` has rows in, the first one clipped to `start`. The
+    # spine and the daily and hourly tables are aggregated a year at a time: DuckDB only spills a hash aggregate
+    # while its per-group states are narrow, and with several states per measure one statement over the whole
+    # history ran out of a 256MB --memory-limit once the file passed ~2M readings. A year of slots fits however
+    # long the file is
+    years = conn.execute(f"""
+    SELECT DISTINCT YEAR(timestamp) FROM {table_name}
+    {f"WHERE timestamp >= TIMESTAMP '{start}'" if start else ''}
+    ORDER BY 1
+    """).fetchall()
+    start = pd.Timestamp(start).to_pydatetime() if start else datetime.datetime.min
+    return [(max(start, datetime.datetime(year, 1, 1)), datetime.datetime(year + 1, 1, 1)) for (year,) in years]
+
+
+def spine_start(conn, since):
+    # an incremental refresh starts from the last slot before `since`, so the run of missing slots after it can be interpolated
+    return conn.execute(f"""
+    SELECT COALESCE(time_bucket(INTERVAL '{INTERVAL_MINUTES} minutes', MAX(timestamp)), TIMESTAMP '{since}')
+    FROM warehouse.dim_datetime WHERE timestamp < TIMESTAMP '{since}'
+    """).fetchone()[0]
+
+
+def slots_select_query(start=None, end=None):
+    # every reading in [start, end) snapped to the 5-minute slot it falls in, duplicate readings of a slot averaged
+    interval = f"INTERVAL '{INTERVAL_MINUTES} minutes'"
+    measures = ', '.join(f'AVG(eof.{column})::{MEASURE_TYPES[column]} as {column}' for column in MEASURE_COLUMNS)
+    filters = ([f"dt.timestamp >= TIMESTAMP '{start}'"] if start else []) + ([f"dt.timestamp < TIMESTAMP '{end}'"] if end else [])
+
+    query = f"""
+    SELECT time_bucket({interval}, dt.timestamp) as timestamp, COUNT(*)::UINTEGER as readings, false as interpolated, {measures}
+    FROM warehouse.fct_gridwatch g
+    JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
+    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id
+    {f"WHERE {' AND '.join(filters)}" if filters else ''}
+    GROUP BY 1
+    """
+    return query
+
+
+def missing_slots_select_query():
+    # the slots of every run in warehouse.gap_index, interpolated linearly between the readings either side when the
+    # run is short enough and NULL otherwise. Joining on the staged slots keeps only the runs they bound
+    interval = f"INTERVAL '{INTERVAL_MINUTES} minutes'"
+    measures = ',\n        '.join(
+        f'(CASE WHEN gaps.interpolated THEN before.{column} + (after.{column} - before.{column}) * position END)::{MEASURE_TYPES[column]} as {column}'
+        for column in MEASURE_COLUMNS
+    )
+
+    query = f"""
+    SELECT
+        slot as timestamp,
+        NULL::UINTEGER as readings,
+        gaps.interpolated,
+        {measures}
+    FROM (
+        SELECT *,
+            unnest(generate_series(gap_start, gap_end, {interval})) as slot,
+            (epoch(slot) - epoch(gap_start - {interval})) / (epoch(gap_end + {interval}) - epoch(gap_start - {interval})) as position
+        FROM warehouse.gap_index
+    ) gaps
+    JOIN normalized_readings before ON before.timestamp = gaps.gap_start - {interval}
+    JOIN normalized_readings after ON after.timestamp = gaps.gap_end + {interval}
+    """
+    return query
+
+
+def create_normalized_readings(conn, since=None):
+    # the readings on a regular spine of 5-minute slots, staged once per build and read by every aggregate grain.
+    # Only the slots with readings are aggregated from the facts; the few missing ones come from the gap index.
+    # Staged in the database file rather than as a TEMP table, so its blocks can be evicted under --memory-limit;
+    # use it through staged_readings, which drops it again
+    create_gap_index(conn)
+    conn.execute(f'CREATE OR REPLACE TABLE normalized_readings AS {slots_select_query()} LIMIT 0')
+    for start, end in year_batches(conn, 'warehouse.dim_datetime', spine_start(conn, since) if since else None):
+        conn.execute(f'INSERT INTO normalized_readings {slots_select_query(start, end)}')
+    conn.execute(f'INSERT INTO normalized_readings {missing_slots_select_query()}')
+
+
+@contextlib.contextmanager
+def staging_tables(conn, *table_names):
+    # staging tables live in the database file, so they are dropped however the block ends and a failed build
+    # leaves none behind
+    try:
+        yield
+    finally:
+        for table_name in table_names:
+            conn.execute(f'DROP TABLE IF EXISTS {table_name}')
+
+
+@contextlib.contextmanager
+def replacing(db_path, copy=False):
+    # a connection to a staging file that replaces db_path once the block succeeds; a failed build removes it. The
+    # swap is a rename, so readers holding db_path open keep the old file until they reopen, and no writer ever
+    # needs the lock their read-only connections hold. copy starts the staging file from the current database
+    staging_path = f'{db_path}.tmp'
+    remove_database(staging_path)
+    if copy:
+        shutil.copyfile(db_path, staging_path)
+    conn = ddb.connect(staging_path)
+    try:
+        yield conn
+    except BaseException:
+        conn.close()
+        remove_database(staging_path)
+        raise
+    conn.close()
+    os.replace(staging_path, db_path)
+
+
+def remove_database(path):
+    for file_path in (path, f'{path}.wal'):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(file_path)
+
+
+@contextlib.contextmanager
+def staged_readings(conn, since=None):
+    with staging_tables(conn, 'normalized_readings'):
+        create_normalized_readings(conn, since)
+        yield
+
+
+def read_emission_factors(path):
+    # a JSON object of gCO2/kWh per source, merged over EMISSION_FACTORS
+    with open(path) as f:
+        overrides = json.load(f)
+    unknown = set(overrides) - set(GENERATION_COLUMNS)
+    if unknown:
+        raise ValueError(f'Unknown generation sources in {path}: {sorted(unknown)}')
+    for column, factor in overrides.items():
+        if isinstance(factor, bool) or not isinstance(factor, (int, float)) or factor < 0:
+            raise ValueError(f'Emission factor for {column} must be a non-negative number, got {factor!r}')
+    return {**EMISSION_FACTORS, **overrides}
+
+
+def load_emission_factors(conn):
+    # the factors the warehouse was built with, so an incremental refresh stays consistent with the rows before it
+    if not table_exists(conn, 'emission_factors'):
+        return dict(EMISSION_FACTORS)
+    return dict(conn.execute('SELECT source, g_co2_per_kwh FROM warehouse.emission_factors').fetchall())
+
+
+def store_emission_factors(conn, emission_factors):
+    conn.execute('CREATE OR REPLACE TABLE warehouse.emission_factors (source VARCHAR, g_co2_per_kwh DOUBLE)')
+    conn.executemany('INSERT INTO warehouse.emission_factors VALUES (?, ?)', [[column, emission_factors[column]] for column in GENERATION_COLUMNS])
+
+
+def mix_select_query(emission_factors):
+    # the normalized slots with their total generation and emission rate; a slot missing any source has neither
+    generation = ' + '.join(GENERATION_COLUMNS)
+    emissions = ' + '.join(f'{column} * {float(emission_factors[column])}' for column in GENERATION_COLUMNS if emission_factors[column])
+    query = f"""
+    SELECT *, ({generation})::INTEGER as generation, ({emissions or '0'})::DOUBLE as emissions
+    FROM normalized_readings
+    """
+    return query
+
+
+def mix_columns(period_sum):
+    # fuel shares and carbon intensity of a period, always from the period's sums rather than averaged over its
+    # slots or days; period_sum gives the SQL for the sum of a measure over the period
+    generation = f"NULLIF({period_sum('generation')}, 0)"
+    shares = [f"{period_sum(column)} / {generation} {column}_share" for column in GENERATION_COLUMNS]
+    return ',\n        '.join(shares + [f"{period_sum('emissions')} / {generation} carbon_intensity"])
+
+
+def agg_daily_select_query(since=None, hourly=False, emission_factors=EMISSION_FACTORS, until=None):
+    # one row per day (or hour) with sum/avg/min/max/count of every measure over the normalized 5-minute slots, so the
+    # dashboard never has to touch the facts and a day with missing readings is not summed short. Days inside a long
+    # outage are kept with NULL measures so the daily series stays regular. `slots` counts the period's slots on the
+    # spine, missing ones included, so a total can be scaled up over the outages inside the period; the spine only
+    # runs from the first reading to the last, so the periods at either end of the data are not extrapolated past it.
+    # min/max keep the measure's declared type; sums are DOUBLE rather than the 16-byte HUGEINT and counts fit 32 bits
+    measures = ',\n        '.join(
+        f'SUM({column})::DOUBLE {column}_sum, AVG({column}) {column}_avg, MIN({column}) {column}_min, '
+        f'MAX({column}) {column}_max, COUNT({column})::UINTEGER {column}_count'
+        for column in MEASURE_COLUMNS + DERIVED_MEASURES
+    )
+    filters = ([f"timestamp >= TIMESTAMP '{since}'"] if since else []) + ([f"timestamp < TIMESTAMP '{until}'"] if until else [])
+
+    query = f"""
+    SELECT 
+        {"date_trunc('hour', timestamp) as hour," if hourly else ''}
+        timestamp::date as date,
+        YEAR(timestamp::date) as year,
+        MONTH(timestamp::date) as month,
+        COALESCE(SUM(readings), 0)::UINTEGER as readings,
+        COUNT_IF(interpolated)::UINTEGER as interpolated,
+        COUNT(*)::UINTEGER as slots,
+        {measures},
+        {mix_columns(lambda column: f'SUM({column})')},
+        MIN(emissions / NULLIF(generation, 0)) carbon_intensity_min,
+        MAX(emissions / NULLIF(generation, 0)) carbon_intensity_max
+    FROM ({mix_select_query(emission_factors)})
+    {f"WHERE {' AND '.join(filters)}" if filters else ''}
+    GROUP BY {'1, 2, 3, 4' if hourly else '1, 2, 3'}
+    """
+    return query
+
+
+def rollup_select_query(grain, since=None):
+    # rolls agg_daily up to weeks, months or years; `date` is the first day of the period, weeks are ISO weeks
+    # starting on Monday and carry their ISO year and week number
+    measures = ',\n        '.join(
+        f'SUM({column}_sum) {column}_sum, SUM({column}_sum) / SUM({column}_count) {column}_avg, MIN({column}_min) {column}_min, '
+        f'MAX({column}_max) {column}_max, SUM({column}_count)::UINTEGER {column}_count'
+        for column in MEASURE_COLUMNS + DERIVED_MEASURES
+    )
+
+    query = f"""
+    SELECT
+        date_trunc('{grain}', date) as date,
+        YEAR(date_trunc('{grain}', date)) as year,
+        MONTH(date_trunc('{grain}', date)) as month,
+        {"ISOYEAR(date) as iso_year, WEEK(date) as iso_week," if grain == 'week' else ''}
+        SUM(readings)::UINTEGER as readings,
+        SUM(interpolated)::UINTEGER as interpolated,
+        SUM(slots)::UINTEGER as slots,
+        {measures},
+        {mix_columns(lambda column: f'SUM({column}_sum)')},
+        MIN(carbon_intensity_min) carbon_intensity_min,
+        MAX(carbon_intensity_max) carbon_intensity_max
+    FROM warehouse.agg_daily
+    {f"WHERE date >= date_trunc('{grain}', DATE '{since}')" if since else ''}
+    GROUP BY {'1, 2, 3, 4, 5' if grain == 'week' else '1, 2, 3'}
+    """
+    return query
+
+
+def insert_agg_by_year(conn, table_name, since=None, hourly=False, emission_factors=EMISSION_FACTORS):
+    # a year of normalized slots per statement, see year_batches
+    for start, end in year_batches(conn, 'normalized_readings', since):
+        query = agg_daily_select_query(start, hourly, emission_factors, until=end)
+        conn.execute(f"INSERT INTO warehouse.{table_name} {query} ORDER BY {'hour' if hourly else 'date'}")
+
+
+def create_agg_tables(conn, emission_factors=None):
+    # without explicit emission factors a rebuild keeps the ones the warehouse already has
+    emission_factors = emission_factors or load_emission_factors(conn)
+    store_emission_factors(conn, emission_factors)
+    with staged_readings(conn):
+        conn.execute(f'CREATE OR REPLACE TABLE warehouse.agg_daily AS {agg_daily_select_query(emission_factors=emission_factors)} LIMIT 0')
+        insert_agg_by_year(conn, 'agg_daily', emission_factors=emission_factors)
+        create_grain_tables(conn, emission_factors)
+
+
+def create_grain_tables(conn, emission_factors=EMISSION_FACTORS):
+    # the rest of the grain pyramid around agg_daily; queries.py reads the coarsest one that fits a request
+    conn.execute(f"CREATE OR REPLACE TABLE warehouse.agg_hourly AS {agg_daily_select_query(hourly=True, emission_factors=emission_factors)} LIMIT 0")
+    insert_agg_by_year(conn, 'agg_hourly', hourly=True, emission_factors=emission_factors)
+    for grain, table_name in ROLLUP_TABLES.items():
+        conn.execute(f"CREATE OR REPLACE TABLE warehouse.{table_name} AS {rollup_select_query(grain)} ORDER BY date")
+
+
+def gap_index_select_query():
+    # one row per run of missing 5-minute slots: its first and last missing slot, its length and whether the
+    # aggregates interpolated it. Runs are disjoint, so sorted by gap_start they are sorted by gap_end as well
+    interval = f"INTERVAL '{INTERVAL_MINUTES} minutes'"
+    query = f"""
+    WITH slots AS (
+        SELECT DISTINCT time_bucket({interval}, timestamp) as slot FROM warehouse.dim_datetime
+    ),
+    steps AS (
+        SELECT slot, LEAD(slot) OVER (ORDER BY slot) as next_slot FROM slots
+    )
+    SELECT
+        slot + {interval} as gap_start,
+        next_slot - {interval} as gap_end,
+        ((epoch(next_slot) - epoch(slot)) / {INTERVAL_MINUTES * 60} - 1)::UINTEGER as missing_slots,
+        missing_slots <= {MAX_INTERPOLATED_SLOTS} as interpolated
+    FROM steps
+    WHERE next_slot - slot > {interval}
     """
+    return query
 
-    create_dim_datetime_query ="""
-    CREATE OR REPLACE TABLE warehouse.dim_datetime AS
-    SELECT * FROM read_parquet('data/dim_datetime.gzip');
+
+def create_gap_index(conn):
+    # small enough to rebuild whole on every load
+    conn.execute(f'CREATE OR REPLACE TABLE warehouse.gap_index AS {gap_index_select_query()} ORDER BY gap_start')
+
+
+def wide_select_query(after=None):
+    measures = ', '.join(f'eof.{column}' for column in MEASURE_COLUMNS)
+
+    query = f"""
+    SELECT 
+        g.fact_id,
+        dt.timestamp,
+        dt.timestamp::date as date,
+        dt.year,
+        dt.month,
+        dt.week,
+        dt.day_of_week,
+        dt.hour,
+        {measures}
+    FROM warehouse.fct_gridwatch g
+    LEFT JOIN warehouse.dim_datetime dt ON dt.datetime_id = g.datetime_id
+    LEFT JOIN warehouse.dim_energy_output_and_flow eof ON eof.energy_id = g.energy_id
+    {f"WHERE dt.timestamp > TIMESTAMP '{after}'" if after else ''}
+    ORDER BY dt.timestamp
     """
+    return query
 
-    create_dim_energy_output_and_flow_query ="""
-    CREATE OR REPLACE TABLE warehouse.dim_energy_output_and_flow AS
-    SELECT * FROM read_parquet('data/dim_energy_output_and_flow.gzip');
+
+def create_wide_table(conn):
+    # denormalized copy of the star schema, physically ordered by timestamp so the
+    # zone maps on timestamp/date let date-range filters skip whole row groups
+    create_wide_table_query = f"""
+    CREATE OR REPLACE TABLE warehouse.gridwatch_wide AS
+    {wide_select_query()};
     """
 
-    conn.execute(create_fct_table_query)
+    conn.execute(create_wide_table_query)
+
+
+def refresh_derived_tables(conn, high_water_mark):
+    # only the days from the old high-water mark onwards can have changed
+    since = high_water_mark.date()
+    emission_factors = load_emission_factors(conn)
+    with staged_readings(conn, since):
+        conn.execute(f"DELETE FROM warehouse.agg_daily WHERE date >= DATE '{since}'")
+        insert_agg_by_year(conn, 'agg_daily', since, emission_factors=emission_factors)
 
-    conn.execute(create_dim_datetime_query)
+        if table_exists(conn, 'agg_hourly'):
+            conn.execute(f"DELETE FROM warehouse.agg_hourly WHERE date >= DATE '{since}'")
+            insert_agg_by_year(conn, 'agg_hourly', since, hourly=True, emission_factors=emission_factors)
+        for grain, table_name in ROLLUP_TABLES.items():
+            # the period holding the old high-water mark is rebuilt whole
+            if table_exists(conn, table_name):
+                conn.execute(f"DELETE FROM warehouse.{table_name} WHERE date >= date_trunc('{grain}', DATE '{since}')")
+                conn.execute(f"INSERT INTO warehouse.{table_name} {rollup_select_query(grain, since)} ORDER BY date")
+
+    if table_exists(conn, 'gridwatch_wide'):
+        conn.execute(f"INSERT INTO warehouse.gridwatch_wide {wide_select_query(high_water_mark)}")
+
+
+def export_parquet_dataset(conn, dataset_dir=PARQUET_DATASET_DIR, compression='zstd', row_group_size=122_880, partition=True):
+    # sorted by date and hive-partitioned by year/month, so a reader filtering on a date range only opens
+    # the matching partitions and the row-group statistics on date skip the rest
+    tables = [table_name for table_name in ['agg_daily', 'agg_hourly', *ROLLUP_TABLES.values(), 'gridwatch_wide']
+              if table_exists(conn, table_name)]
+    if os.path.exists(dataset_dir):
+        shutil.rmtree(dataset_dir)
+    os.makedirs(dataset_dir)
+
+    for table_name in tables:
+        target = f'{dataset_dir}/{table_name}' if partition else f'{dataset_dir}/{table_name}.parquet'
+        options = f'FORMAT PARQUET, COMPRESSION {compression}, ROW_GROUP_SIZE {row_group_size}'
+        if partition:
+            options += ', PARTITION_BY (year, month)'
+        conn.execute(f"COPY (SELECT * FROM warehouse.{table_name} ORDER BY date) TO '{target}' ({options})")
+
+
+def export_snapshot(conn, snapshot_dir=SNAPSHOT_DIR):
+    # one .npy file per column of the normalized 5-minute slots, so the summaries it serves match the aggregate
+    # tables: timestamps as datetime64[s] and the measures as float32 with NaN for missing readings. main.py
+    # memory-maps them, so app processes on one host share the same pages
+    measures = ', '.join(f'{column}::FLOAT as {column}' for column in MEASURE_COLUMNS)
+    # written next to the old snapshot and swapped in, so a running app keeps its mapped files until it restarts
+    staging_dir = f'{snapshot_dir}.tmp'
+    with staging_tables(conn, 'snapshot'):
+        with staged_readings(conn):
+            conn.execute(f"CREATE OR REPLACE TABLE snapshot AS SELECT timestamp, {measures} FROM normalized_readings ORDER BY timestamp")
+
+        if os.path.exists(staging_dir):
+            shutil.rmtree(staging_dir)
+        os.makedirs(staging_dir)
+        timestamps = conn.execute('SELECT timestamp FROM snapshot').fetchnumpy()['timestamp']
+        np.save(f'{staging_dir}/timestamp.npy', timestamps.astype('datetime64[s]'))
+        for column in MEASURE_COLUMNS:
+            values = conn.execute(f'SELECT {column} FROM snapshot').fetchnumpy()[column]
+            np.save(f'{staging_dir}/{column}.npy', np.ma.filled(values.astype(np.float32), np.nan))
+    # recorded so an app never serves a snapshot the warehouse has moved on from
+    with open(f'{staging_dir}/{SOURCE_FILE}', 'w') as f:
+        json.dump(warehouse_version(conn), f)
+
+    if os.path.exists(snapshot_dir):
+        shutil.rmtree(snapshot_dir)
+    os.rename(staging_dir, snapshot_dir)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Build gridwatch.db from the Gridwatch CSV extract')
+    parser.add_argument('--csv', default=CSV_PATH, help='Gridwatch CSV extract to load')
+    parser.add_argument('--db', default=DB_PATH, help='DuckDB database file to build')
+    parser.add_argument('--mode', choices=['pandas', 'streaming', 'sql'], default='pandas',
+                        help='pandas loads the whole CSV in memory, streaming loads it in chunks straight into DuckDB, '
+                             'sql runs the transforms inside DuckDB')
+    parser.add_argument('--chunksize', type=int, default=100_000, help='rows per chunk in streaming mode')
+    parser.add_argument('--memory-limit', help="DuckDB memory_limit for the build, e.g. '1GB'")
+    parser.add_argument('--wide', action='store_true', help='also build the denormalized warehouse.gridwatch_wide table')
+    parser.add_argument('--compression', choices=['zstd', 'snappy', 'gzip'], default='zstd', help='parquet compression codec')
+    parser.add_argument('--row-group-size', type=int, default=122_880, help='rows per parquet row group')
+    parser.add_argument('--parquet-dataset', action='store_true',
+                        help=f'also export the dashboard tables as a parquet dataset under {PARQUET_DATASET_DIR}')
+    parser.add_argument('--no-partition', action='store_true', help='write the parquet dataset as single sorted files')
+    parser.add_argument('--snapshot', action='store_true',
+                        help=f'also write a memory-mapped float32 snapshot of the readings to {SNAPSHOT_DIR}')
+    parser.add_argument('--emission-factors',
+                        help='JSON file of gCO2/kWh per generation source, overriding the defaults in EMISSION_FACTORS')
+    parser.add_argument('--incremental', action='store_true',
+                        help='append the rows of --csv newer than the existing warehouse instead of rebuilding it')
+    args = parser.parse_args()
+    if args.incremental and args.emission_factors:
+        parser.error('--incremental keeps the emission factors the warehouse was built with; rebuild it to change them')
+    return args
 
-    conn.execute(create_dim_energy_output_and_flow_query)
 
 def main():
-    run_etl_pipeline()
-    conn = ddb.connect('gridwatch.db') #open connection if db exists or create db
-    create_schema(conn)
-    create_tables_in_schema(conn)
-    conn.close() #close connection
-    
-main()
\ No newline at end of file
+    args = parse_args()
+    emission_factors = read_emission_factors(args.emission_factors) if args.emission_factors else None
+    if emission_factors is None and not args.incremental and os.path.exists(args.db):
+        # a rebuild starts from an empty file, so the factors the old warehouse was built with are read first
+        with ddb.connect(args.db, read_only=True) as old:
+            emission_factors = load_emission_factors(old)
+    if args.mode == 'pandas' and not args.incremental:
+        run_etl_pipeline(args.csv, compression=args.compression, row_group_size=args.row_group_size)
+
+    with replacing(args.db, copy=args.incremental) as conn:
+        if args.memory_limit:
+            conn.execute(f"SET memory_limit = '{args.memory_limit}'")
+        if args.incremental:
+            high_water_mark, appended = run_incremental_load(conn, args.csv, args.chunksize)
+        else:
+            if args.mode == 'pandas':
+                create_schema(conn)
+                create_tables_in_schema(conn)
+            elif args.mode == 'streaming':
+                run_streaming_etl_pipeline(conn, args.csv, args.chunksize)
+            elif args.mode == 'sql':
+                run_sql_etl_pipeline(conn, args.csv)
+            create_agg_tables(conn, emission_factors)
+            if args.wide:
+                create_wide_table(conn)
+        if args.parquet_dataset:
+            export_parquet_dataset(conn, compression=args.compression, row_group_size=args.row_group_size, partition=not args.no_partition)
+        if args.snapshot:
+            export_snapshot(conn)
+    if args.incremental:
+        print(f'Appended {appended} rows newer than {high_water_mark} to {args.db}, peak RSS {peak_rss_mb():.0f} MB')
+    else:
+        print(f'Built {args.db} in {args.mode} mode, peak RSS {peak_rss_mb():.0f} MB')
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
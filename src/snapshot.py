@@ -0,0 +1,82 @@
+import datetime
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# what the warehouse held when the snapshot was written, see warehouse_version
+SOURCE_FILE = 'source.json'
+
+
+def warehouse_version(conn):
+    # the readings behind the daily aggregates and the last day they reach; an incremental load or a rebuild from
+    # another extract changes them
+    readings, last_date = conn.execute('SELECT SUM(readings), MAX(date) FROM warehouse.agg_daily').fetchone()
+    return {'readings': int(readings or 0), 'last_date': last_date.isoformat() if last_date else None}
+
+
+class Snapshot:
+    # the readings written by `setup_db.py --snapshot`, memory-mapped read-only. Opening it reads nothing, a query
+    # only pages in the slice of the columns it touches, and processes mapping the same files share those pages
+
+    def __init__(self, snapshot_dir):
+        self.snapshot_dir = snapshot_dir
+        self.columns = {
+            entry[:-len('.npy')]: np.load(os.path.join(snapshot_dir, entry), mmap_mode='r')
+            for entry in sorted(os.listdir(snapshot_dir)) if entry.endswith('.npy')
+        }
+        self.timestamp = self.columns.pop('timestamp')
+        source_path = os.path.join(snapshot_dir, SOURCE_FILE)
+        self.source = None
+        if os.path.exists(source_path):
+            with open(source_path) as f:
+                self.source = json.load(f)
+
+    def matches(self, conn):
+        # whether the snapshot was written from the warehouse conn reads; one without a record never matches
+        return self.source is not None and self.source == warehouse_version(conn)
+
+    def position(self, day):
+        # first reading on or after the start of day; timestamps are sorted, so this is a binary search
+        return int(np.searchsorted(self.timestamp, np.datetime64(day, 's')))
+
+    def periods(self, starts, end_date):
+        # [start, stop) row ranges of the periods beginning on `starts`, the last one ending with end_date
+        bounds = [self.position(start) for start in starts] + [self.position(end_date + datetime.timedelta(days=1))]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def aggregate(self, column, periods, statistic):
+        # a 'sum' is scaled up over the missing slots of the period like queries.period_total; the snapshot holds a
+        # row for every slot on the spine, so the length of the slice is the period's slot count
+        values = self.columns[column]
+        results = []
+        for start, stop in periods:
+            chunk = values[start:stop]
+            present = ~np.isnan(chunk)
+            total = float(np.sum(chunk, where=present, dtype=np.float64))
+            count = int(np.count_nonzero(present))
+            mean = total / count if count else np.nan
+            results.append(mean * len(chunk) if statistic == 'sum' else mean)
+        return results
+
+    def yearly(self, columns, start_date, end_date, statistic='mean'):
+        years = range(start_date.year, end_date.year + 1)
+        starts = [start_date] + [datetime.date(year, 1, 1) for year in years[1:]]
+        periods = self.periods(starts, end_date)
+        # like GROUP BY, years without readings are left out
+        kept = [index for index, (start, stop) in enumerate(periods) if stop > start]
+        periods = [periods[index] for index in kept]
+        df = pd.DataFrame({'year': [str(years[index]) for index in kept]})
+        for column in columns:
+            df[column] = self.aggregate(column, periods, statistic)
+        return df
+
+    def monthly(self, column, year, statistic='sum'):
+        starts = [datetime.date(year, month, 1) for month in range(1, 13)]
+        periods = self.periods(starts, datetime.date(year, 12, 31))
+        kept = [index for index, (start, stop) in enumerate(periods) if stop > start]
+        return pd.DataFrame({
+            'month': [index + 1 for index in kept],
+            column: self.aggregate(column, [periods[index] for index in kept], statistic),
+        })
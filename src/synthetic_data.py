@@ -0,0 +1,91 @@
+import argparse
+
+import duckdb as ddb
+
+from setup_db import MAX_INTERPOLATED_SLOTS
+
+# rows in gridwatch_110514_240914.csv: 5-minute readings from May 2011 to September 2024
+BASE_ROW_COUNT = 1_400_000
+START_TIMESTAMP = '2011-05-14 00:00:00'
+# the real extract has outages and repeated readings, so the synthetic one does too: once a week a run of 1 to
+# MAX_INTERPOLATED_SLOTS slots is missing, which the build interpolates, and once a month a run of 13 slots to a day,
+# which stays missing. Every DUPLICATE_EVERY-th reading is written twice, the second time under a new id
+WEEK_SLOTS = 7 * 288
+MONTH_SLOTS = 30 * 288
+DUPLICATE_EVERY = 997
+
+FUEL_SHARES = {
+    'coal': 0.12, 'nuclear': 0.20, 'ccgt': 0.35, 'wind': 0.15, 'pumped': 0.01,
+    'hydro': 0.01, 'biomass': 0.05, 'oil': 0.0, 'solar': 0.03, 'ocgt': 0.002,
+}
+INTERCONNECTORS = ['french_ict', 'dutch_ict', 'irish_ict', 'ew_ict', 'nemo', 'ifa2', 'intelec_ict', 'nsl', 'vkl_ict']
+
+
+def noise(seed):
+    # deterministic pseudo-random value in [-1, 1) per row, so every run writes the same file
+    return f'((hash(i * 1000003 + {seed}) % 20000) / 10000.0 - 1)'
+
+
+def outage(i):
+    # whether slot i falls in one of the outages; the length of a run changes from one week or month to the next
+    short_run = f'{i} % {WEEK_SLOTS} BETWEEN 1000 AND 1000 + ({i} // {WEEK_SLOTS}) % {MAX_INTERPOLATED_SLOTS}'
+    long_run = f'{i} % {MONTH_SLOTS} BETWEEN 5000 AND 5000 + {MAX_INTERPOLATED_SLOTS} + ({i} // {MONTH_SLOTS}) % 24 * 12'
+    return f'({short_run} OR {long_run})'
+
+
+def synthetic_csv_query(rows):
+    # Gridwatch-shaped rows over `rows` 5-minute slots: demand with yearly and daily seasonality, fuels as noisy
+    # shares of demand and interconnector flows swinging between import and export, with the outages and duplicates
+    # described above. Sorted by timestamp like a real extract
+    day_of_year = f"DAYOFYEAR(TIMESTAMP '{START_TIMESTAMP}' + to_minutes(5 * i))"
+    hour = f"HOUR(TIMESTAMP '{START_TIMESTAMP}' + to_minutes(5 * i))"
+    demand = f'(30000 + 7000 * cos(2 * pi() * ({day_of_year} - 15) / 365.25) + 5000 * sin(2 * pi() * ({hour} - 9) / 24) + 1500 * {noise(1)})'
+
+    fuels = ',\n        '.join(
+        f'GREATEST({demand} * {share} * (1 + 0.3 * {noise(seed)}), 0)::BIGINT as {fuel}'
+        for seed, (fuel, share) in enumerate(FUEL_SHARES.items(), start=10)
+    )
+    interconnectors = ',\n        '.join(
+        f'(1000 * sin(2 * pi() * ({hour} + {seed}) / 24) + 400 * {noise(seed)})::BIGINT as {column}'
+        for seed, column in enumerate(INTERCONNECTORS, start=30)
+    )
+
+    return f"""
+    WITH readings AS (
+    SELECT
+        i,
+        i + 1 as id,
+        TIMESTAMP '{START_TIMESTAMP}' + to_minutes(5 * i) as timestamp,
+        {demand}::BIGINT as demand,
+        ROUND(50 + 0.05 * {noise(2)}, 3) as frequency,
+        {fuels},
+        {interconnectors},
+        (200 * {noise(3)})::BIGINT as other,
+        (5000 + 2000 * {noise(4)})::BIGINT as north_south,
+        (3000 + 1500 * {noise(5)})::BIGINT as scotland_england
+    FROM range({int(rows)}) t(i)
+    WHERE NOT {outage('i')}
+    )
+    SELECT * EXCLUDE (i) FROM readings
+    UNION ALL BY NAME
+    SELECT * EXCLUDE (i, id), {int(rows)} + id as id FROM readings WHERE i % {DUPLICATE_EVERY} = 0
+    ORDER BY timestamp, id
+    """
+
+
+def generate_csv(path, rows):
+    # returns the rows written, which the outages and duplicates make differ from `rows`
+    with ddb.connect() as conn:
+        return conn.execute(f"COPY ({synthetic_csv_query(rows)}) TO '{path}' (HEADER, DELIMITER ',')").fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic Gridwatch-shaped CSV extract')
+    parser.add_argument('path')
+    parser.add_argument('--scale', type=float, default=1, help='multiple of the real extract row count, in 5-minute slots')
+    args = parser.parse_args()
+    generate_csv(args.path, BASE_ROW_COUNT * args.scale)
+
+
+if __name__ == '__main__':
+    main()